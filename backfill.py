@@ -0,0 +1,144 @@
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from openpyxl import Workbook
+from openpyxl.utils.dataframe import dataframe_to_rows
+
+from bart import run_country
+from db_queries import get_backfill_sources, slice_backfill_sources
+from gdrive import download_broadcast_config
+from helper import DTFormat, get_weeks, make_local_filename, prune_work_dirs
+from homer import SOURCE_COLUMNS, add_report_styles, _styled_cell
+import metrics
+import query_cache
+
+TREND_KEYS = ['country', 'platform', 'gateway', 'operator_code',
+              'service_identifier1', 'service_identifier2', 'frequency']
+
+
+def run_windows(country, weeks, broadcast_config, workers=1):
+    # Fetch the data of all weeks once, then run the pipeline per week on
+    # in-memory slices, at most `workers` weeks at a time
+    metrics.set_week(weeks[0][0], weeks[-1][1])
+    with metrics.stage(country, 'backfill_fetch') as m:
+        sources = get_backfill_sources(country, weeks, columns=SOURCE_COLUMNS)
+        m['rows_out'] = len(sources['active'])
+    records = metrics.pop_records()
+
+    results = []
+    for i in range(0, len(weeks), workers):
+        batch = weeks[i:i + workers]
+        args = [
+            (country, start_date, end_date, broadcast_config,
+             slice_backfill_sources(sources, start_date, end_date))
+            for start_date, end_date in batch
+        ]
+        if workers <= 1:
+            results += [run_country(*arg) for arg in args]
+            continue
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results += list(executor.map(run_country, *zip(*args)))
+    return results, records
+
+
+def build_trend(countries):
+    # One row per service and two columns per week: active users and users
+    # without transactions
+    frames = []
+    for x in countries:
+        if x.results.empty:
+            continue
+        df = x.results[TREND_KEYS[1:] + ['active_users', 0]].copy()
+        df.insert(0, 'country', x.country)
+        df['week'] = x.start_date.strftime(DTFormat.Y_M_D)
+        frames.append(df.rename(columns={0: 'without_transactions'}))
+    if not frames:
+        return pd.DataFrame()
+
+    df = pd.concat(frames, ignore_index=True)
+    df[TREND_KEYS] = df[TREND_KEYS].astype(str)
+    trend = df.pivot_table(
+        index=TREND_KEYS, columns='week',
+        values=['active_users', 'without_transactions'], aggfunc='sum'
+    )
+    trend = trend.swaplevel(axis=1).sort_index(axis=1)
+    trend.columns = ['{} {}'.format(week, metric.replace('_', ' '))
+                     for week, metric in trend.columns]
+    return trend.reset_index()
+
+
+def write_trend(trend, filename):
+    wb = Workbook(write_only=True)
+    add_report_styles(wb)
+    ws = wb.create_sheet('Trend')
+    ws.append([_styled_cell(ws, col, 'bart_header') for col in trend.columns])
+    styles = ['bart_text'] * len(TREND_KEYS) + ['bart_default'] * (len(trend.columns) - len(TREND_KEYS))
+    for row in dataframe_to_rows(trend, index=False, header=False):
+        ws.append([_styled_cell(ws, value, style) for value, style in zip(row, styles)])
+    wb.save(filename)
+
+
+def backfill(start_date, end_date, workers=None):
+    print('BART backfilling {} to {}...'.format(
+        start_date.strftime(DTFormat.Y_M_D), end_date.strftime(DTFormat.Y_M_D)))
+    weeks = get_weeks(start_date, end_date)
+    if not weeks:
+        print('No full week between these dates')
+        return
+    if workers is None:
+        workers = int(os.getenv('BART_WORKERS') or 1)
+
+    broadcast_config = download_broadcast_config()
+    countries = broadcast_config['country_code'].unique()
+
+    workbooks = dict((week, Workbook(write_only=True)) for week in weeks)
+    week_records = dict((week, []) for week in weeks)
+    fetch_records = []
+    cache_stats = query_cache.pop_stats()
+    done = []
+    for country in countries:
+        results, records = run_windows(country, weeks, broadcast_config, workers)
+        fetch_records += records
+        for week, (x, stats, country_records) in zip(weeks, results):
+            x.write_excel(workbooks[week])
+            week_records[week] += country_records
+            for key in stats:
+                cache_stats[key] += stats[key]
+            done.append(x)
+
+    for week in weeks:
+        local_filename = make_local_filename(week[0], week[1], 'all', 'xlsx')
+        workbooks[week].save(local_filename)
+        metrics.write_report(week_records[week], week[0], week[1])
+        print('Saved {}'.format(local_filename))
+
+    first_start, last_end = weeks[0][0], weeks[-1][1]
+    trend_filename = make_local_filename(first_start, last_end, 'trend', 'xlsx')
+    write_trend(build_trend(done), trend_filename)
+    metrics.write_report(fetch_records, first_start, last_end)
+    for key, value in query_cache.pop_stats().items():
+        cache_stats[key] += value
+    query_cache.print_stats(cache_stats)
+    prune_work_dirs()
+    print('Saved trend sheet to {}'.format(trend_filename))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the weekly review for every week in a date range')
+    parser.add_argument('start_date', help='first day of the range (YYYY-MM-DD)')
+    parser.add_argument('end_date', help='day after the last day of the range (YYYY-MM-DD)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of weeks to run in parallel (default: BART_WORKERS)')
+    args = parser.parse_args(argv)
+    backfill(datetime.strptime(args.start_date, DTFormat.Y_M_D),
+             datetime.strptime(args.end_date, DTFormat.Y_M_D),
+             workers=args.workers)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,39 +1,245 @@
-from openpyxl import Workbook
+import argparse
+import os
+import sys
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 
-from gdrive import download_broadcast_config, upload_to_google_drive, send_email
-from helper import get_dates, make_local_filename, make_gdrive_filename
-from homer import Country
+from helper import (
+    DTFormat, get_dates, get_output_dir, make_local_filename, make_gdrive_filename,
+    make_stage_filename, make_work_filename, prune_work_dirs
+)
+import metrics
+import query_cache
 
+# Each stage stores its output under the report directory of the week, so
+# that any stage can be re-run on its own; the fetched data stays in the
+# query cache, where the link stage reads it again. Heavy libraries are
+# imported by the stages that need them.
+STAGES = ['fetch', 'link', 'analyze', 'report', 'publish']
+COUNTRY_STAGES = ['fetch', 'link', 'analyze']
 
-def main():
-    print('BART waking up...')
-    start_date, end_date = get_dates()
-
-    broadcast_config = download_broadcast_config()
-    countries = broadcast_config['country_code'].unique()
-
-    wb = Workbook()
-    for country in countries:
-        print('\n\nBeginning review for {}...'.format(country))
-        x = Country(country, start_date, end_date, broadcast_config)
-        x.get_active_users()
-        x.get_redshift_transactions()
-        x.set_active_with_trx()
+
+def run_country(country, start_date, end_date, broadcast_config, sources=None, stages=COUNTRY_STAGES):
+    from homer import Country
+
+    print('\n\nBeginning review for {}...'.format(country))
+    metrics.set_week(start_date, end_date)
+    x = Country(country, start_date, end_date, broadcast_config)
+    if 'fetch' in stages:
+        if sources is not None:
+            x.sources = sources
+        else:
+            with metrics.stage(country, 'fetch') as m:
+                x.fetch_sources()
+                m['rows_out'] = sum(len(df) for df in x.sources.values())
+            # Only marks the stage as done, for resumed runs
+            x.save_stage('fetch', [])
+
+    if 'link' in stages:
+        with metrics.stage(country, 'get_active_users') as m:
+            x.get_active_users()
+            m['rows_out'] = len(x.df_active)
+        with metrics.stage(country, 'get_redshift_transactions') as m:
+            x.get_redshift_transactions()
+            m['rows_out'] = len(x.df_red_trx_per_user)
+        with metrics.stage(country, 'set_active_with_trx',
+                           rows_in=len(x.df_active) + len(x.df_red_trx_per_user)) as m:
+            x.set_active_with_trx()
+            m['rows_out'] = len(x.df_active_with_trx)
         x.print_summary()
-        x.run_analysis()
-        x.write_csv()
-        x.write_excel(wb)
-    wb.remove(wb['Sheet'])
+        x.print_memory_report()
+        x.save_stage('link', ['df_active_per_service', 'df_active_with_trx', 'link_stats'])
+        # The drilldown index points into the linked users it was built from
+        x.remove_drilldown_index()
+
+    if 'analyze' in stages:
+        if 'link' not in stages:
+            x.load_stage('link')
+        with metrics.stage(country, 'run_analysis', rows_in=len(x.df_active_with_trx)) as m:
+            x.run_analysis()
+            m['rows_out'] = len(x.results)
+        with metrics.stage(country, 'write_csv', rows_in=len(x.results)):
+            x.write_csv()
+        with metrics.stage(country, 'drilldown_index', rows_in=len(x.df_active_with_trx)):
+            x.save_drilldown_index()
+        x.save_stage('analyze', ['df_active_per_service', 'results'])
+    x.drop_intermediates()
+    return x, query_cache.pop_stats(), metrics.pop_records()
+
+
+def run_countries(countries, start_date, end_date, broadcast_config, workers=1, stages=COUNTRY_STAGES):
+    # A failing country does not stop the others: returns the runs of the
+    # countries that finished, in order, and the errors of those that failed
+    runs, failed = [], {}
+    if workers <= 1:
+        for country in countries:
+            try:
+                runs.append(run_country(country, start_date, end_date, broadcast_config, stages=stages))
+            except Exception as e:
+                traceback.print_exc()
+                failed[country] = e
+        return runs, failed
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(run_country, country, start_date, end_date, broadcast_config,
+                            stages=stages)
+            for country in countries
+        ]
+        for country, future in zip(countries, futures):
+            try:
+                runs.append(future.result())
+            except Exception as e:
+                traceback.print_exception(type(e), e, e.__traceback__)
+                failed[country] = e
+    return runs, failed
+
+
+def finished_countries(countries, start_date, end_date, stage):
+    # The countries whose last stage already stored its output
+    return [country for country in countries
+            if os.path.exists(make_stage_filename(start_date, end_date, country, stage))]
+
+
+def get_broadcast_config(start_date, end_date, download=True):
+    # The fetch stage stores the configuration it ran with; later stages
+    # reuse it, so that re-running them needs no Google Drive access
+    import pandas as pd
+
+    filename = make_work_filename(start_date, end_date, 'broadcast_config')
+    if download or not os.path.exists(filename):
+        from gdrive import download_broadcast_config
+        broadcast_config = download_broadcast_config()
+        pd.to_pickle(broadcast_config, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+        return broadcast_config
+    return pd.read_pickle(filename)
+
+
+def write_report(countries, start_date, end_date, broadcast_config):
+    from openpyxl import Workbook
+    from homer import Country
+
+    wb = Workbook(write_only=True)
+    for x in countries:
+        if isinstance(x, str):
+            x = Country(x, start_date, end_date, broadcast_config)
+            x.load_stage('analyze')
+        with metrics.stage(x.country, 'write_excel', rows_in=len(x.results)):
+            x.write_excel(wb)
 
-    print('\nSaving XLSX to file and uploading to Google Drive...')
+    local_filename = make_local_filename(start_date, end_date, 'all', 'xlsx')
+    print('\nSaving XLSX to {}...'.format(local_filename))
+    with metrics.stage('all', 'save_xlsx'):
+        wb.save(local_filename)
+
+
+def publish(start_date, end_date):
+    from gdrive import upload_to_google_drive, send_email
+
+    print('\nUploading to Google Drive and sending the report...')
     local_filename = make_local_filename(start_date, end_date, 'all', 'xlsx')
     gdrive_filename = make_gdrive_filename(start_date, end_date)
-    wb.save(local_filename)
-    file_id = upload_to_google_drive(local_filename, gdrive_filename)
-    send_email(start_date, local_filename, file_id)
+    with metrics.stage('all', 'publish'):
+        file_id = upload_to_google_drive(local_filename, gdrive_filename)
+        send_email(start_date, local_filename, file_id)
+
+
+def main(stages=STAGES, start_date=None, end_date=None, countries=None, workers=None, resume=False):
+    print('BART waking up...')
+    if start_date is None:
+        start_date, end_date = get_dates()
+    if workers is None:
+        workers = int(os.getenv('BART_WORKERS') or 1)
+    metrics.set_week(start_date, end_date)
+
+    # A resumed run keeps the configuration the finished countries ran with
+    broadcast_config = get_broadcast_config(start_date, end_date,
+                                            download='fetch' in stages and not resume)
+    if countries is None:
+        countries = broadcast_config['country_code'].unique()
+    country_stages = [stage for stage in COUNTRY_STAGES if stage in stages]
+    finished = []
+    if resume and country_stages:
+        finished = finished_countries(countries, start_date, end_date, country_stages[-1])
+        if finished:
+            print('Resuming: {} already finished'.format(', '.join(finished)))
+    pending = [country for country in countries if country not in finished]
+    if country_stages:
+        # A country only counts as finished once this run stores it again
+        for country in pending:
+            filename = make_stage_filename(start_date, end_date, country, country_stages[-1])
+            if os.path.exists(filename):
+                os.remove(filename)
+    if 'fetch' in stages and pending:
+        from db_queries import prefetch_mcb_active, prefetch_redshift_transactions
+        if os.getenv('REDSHIFT_BATCH'):
+            with metrics.stage('all', 'prefetch_redshift_transactions'):
+                prefetch_redshift_transactions(pending, start_date, end_date)
+        if os.getenv('MCB_BATCH'):
+            with metrics.stage('all', 'prefetch_mcb_active'):
+                prefetch_mcb_active(pending, start_date, end_date)
+
+    cache_stats = query_cache.pop_stats()
+    records = metrics.pop_records()
+    # Countries that are not run again are read from their checkpoints by
+    # the report stage
+    results = dict((country, country) for country in countries)
+    failed = {}
+    if country_stages and pending:
+        runs, failed = run_countries(
+            pending, start_date, end_date, broadcast_config, workers, country_stages)
+        for x, stats, country_records in runs:
+            for key in stats:
+                cache_stats[key] += stats[key]
+            records += country_records
+            results[x.country] = x
+        query_cache.print_stats(cache_stats)
+
+    if failed:
+        print('\nFailed: {}. Run again with --resume to retry only these countries.'.format(
+            ', '.join(failed)))
+    else:
+        if 'report' in stages:
+            write_report([results[country] for country in countries],
+                         start_date, end_date, broadcast_config)
+        if 'publish' in stages:
+            publish(start_date, end_date)
+    records += metrics.pop_records()
+    json_file, prom_file = metrics.write_report(records, start_date, end_date)
+    print('Run metrics written to {} and {}'.format(json_file, prom_file))
+    removed = prune_work_dirs(keep=[get_output_dir(start_date, end_date)])
+    if removed:
+        print('Removed the intermediates of {} past weeks'.format(len(removed)))
 
     print('\nBART going back to sleep...')
+    return 1 if failed else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Broadcast Anomaly Review Tool')
+    parser.add_argument('stages', nargs='*', choices=STAGES + ['all'], default='all',
+                        help='stages to run, in pipeline order (default: all)')
+    parser.add_argument('--start-date', help='first day of the week (default: last full week)')
+    parser.add_argument('--end-date', help='day after the last day (default: start date + 7 days)')
+    parser.add_argument('--countries', help='comma-separated country codes (default: all configured)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of countries to run in parallel (default: BART_WORKERS)')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the countries that finished in an earlier run of the same week')
+    args = parser.parse_args(argv)
+
+    stages = STAGES if 'all' in args.stages else [s for s in STAGES if s in args.stages]
+    start_date = end_date = None
+    if args.start_date:
+        start_date = datetime.strptime(args.start_date, DTFormat.Y_M_D)
+        end_date = start_date + timedelta(days=7)
+        if args.end_date:
+            end_date = datetime.strptime(args.end_date, DTFormat.Y_M_D)
+    countries = args.countries.split(',') if args.countries else None
+    return dict(stages=stages, start_date=start_date, end_date=end_date,
+                countries=countries, workers=args.workers, resume=args.resume)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main(**parse_args(sys.argv[1:])))
@@ -0,0 +1,265 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+BASELINE_FILE = os.path.dirname(os.path.abspath(__file__)) + '/benchmark_baseline.json'
+STAGES = ['get_active_users', 'select_unique_schedules', 'add_broadcast_config',
+          'get_redshift_transactions', 'set_active_with_trx', 'run_analysis', 'write_excel']
+
+
+def make_services(n_services, rng):
+    # Services are split between SAM (per-country database) and MCB
+    gateways = np.array(['GW{}'.format(i) for i in range(max(2, n_services // 200))])
+    operators = np.array(['op{}'.format(i) for i in range(8)])
+    platform = np.where(rng.random(n_services) < 0.7, 'sam', 'mcb')
+    return pd.DataFrame({
+        'serviceid': np.arange(1, n_services + 1),
+        'platform': platform,
+        'gateway': rng.choice(gateways, n_services),
+        'service_identifier1': np.char.add('SC', rng.integers(1000, 99999, n_services).astype(str)),
+        'service_identifier2': np.char.add('KW', np.arange(n_services).astype(str)),
+        'operators': [
+            ','.join(sorted(rng.choice(operators, rng.integers(1, 4), replace=False)))
+            for _ in range(n_services)
+        ],
+    })
+
+
+def make_subscribers(n_users, services, start_date, rng):
+    # Service popularity is skewed, as in production
+    weights = 1. / np.arange(1, len(services) + 1)
+    isvc = rng.choice(len(services), n_users, p=weights / weights.sum())
+    svc = services.iloc[isvc].reset_index(drop=True)
+    operator = [ops.split(',')[k % len(ops.split(','))]
+                for ops, k in zip(svc['operators'], rng.integers(0, 3, n_users))]
+    created = start_date - pd.to_timedelta(rng.integers(1, 400, n_users), unit='D')
+    return pd.DataFrame({
+        'accountid': np.arange(1, n_users + 1),
+        'platform': svc['platform'],
+        'msisdn': 60000000000 + rng.choice(10 * n_users, n_users, replace=False),
+        'status': np.where(rng.random(n_users) < 0.95, 'A', 'I'),
+        'createdate': created,
+        'updatedate': created,
+        'gateway': svc['gateway'],
+        'operator_code': operator,
+        'serviceid': svc['serviceid'],
+        'service_identifier1': svc['service_identifier1'],
+        'service_identifier2': svc['service_identifier2'],
+        'rockman_id': np.where(
+            svc['platform'] == 'mcb',
+            np.char.add('rk', np.arange(n_users).astype(str)), None
+        ),
+    })
+
+
+def make_schedules(services, rng):
+    sam = services[services['platform'] == 'sam']
+    # Some services have several schedules for overlapping operators
+    sam = sam.loc[sam.index.repeat(rng.integers(1, 4, len(sam)))].reset_index(drop=True)
+    n = len(sam)
+    return pd.DataFrame({
+        'scheduleid': np.arange(1, n + 1),
+        'gateway': sam['gateway'],
+        'service_identifier1': sam['service_identifier1'],
+        'serviceid': sam['serviceid'],
+        'tariff': rng.choice([100, 250, 500], n),
+        'billing_days': rng.choice(['1', '1,4', '1,3,5', '1,2,3,4,5,6,7'], n),
+        'schedule_status': np.where(rng.random(n) < 0.7, 'A', 'I'),
+        'operator_code': sam['operators'],
+        'updatedate': pd.Timestamp('2020-01-01') + pd.to_timedelta(rng.integers(0, 300, n), unit='D'),
+    })
+
+
+def make_transactions(subscribers, rng):
+    # Per-user counts as returned by redshift_trx_per_user.sql
+    df = subscribers[rng.random(len(subscribers)) < 0.8]
+    n = len(df)
+    total = rng.poisson(2, n)
+    df = pd.DataFrame({
+        'rockman_id': df['rockman_id'].fillna('Unknown').values,
+        'msisdn': df['msisdn'].values,
+        'gateway': df['gateway'].values,
+        'operator_code': df['operator_code'].values,
+        'service_identifier1': df['service_identifier1'].values,
+        'service_identifier2': df['service_identifier2'].values,
+        'platform': df['platform'].values,
+        'total_transactions': total,
+        'delivered_transactions': rng.binomial(total, 0.9),
+    })
+    return df[df['total_transactions'] > 0].reset_index(drop=True)
+
+
+def make_broadcast_config(country, services, rng):
+    # A mix of gateway-wide rules, per-operator rules and per-service rules
+    gateways = services['gateway'].unique()
+    n = len(services) // 10 + len(gateways)
+    config = pd.DataFrame({
+        'country_code': country,
+        'gateway': np.concatenate([gateways, rng.choice(gateways, n - len(gateways))]),
+        'operator_code': '*',
+        'service_identifier1': '*',
+        'service_identifier2': '*',
+    })
+    specific = rng.random(n) < 0.5
+    picked = services.iloc[rng.choice(len(services), n)]
+    config.loc[specific, 'service_identifier1'] = picked['service_identifier1'].values[specific]
+    config.loc[~specific & (rng.random(n) < 0.5), 'operator_code'] = 'op1'
+    config['billing_frequency'] = '1'
+    config['minimum_expected_transactions'] = 1
+    config['maximum_expected_transactions'] = rng.choice([1, 2, 7, -1], n)
+    config.loc[config['maximum_expected_transactions'] < 0, 'minimum_expected_transactions'] = -1
+    config['handled_by'] = 'bench'
+    config['notes'] = ''
+    return config
+
+
+def populate_cache(country, n_users, start_date, end_date, seed=0):
+    # Store the synthetic data as cached query results under the keys the
+    # real queries would use, so Country runs unmodified against them
+    import query_cache
+    from db_queries import (_render_query, _normalize_active, _normalize_schedule,
+                            _normalize_redshift_transactions)
+
+    rng = np.random.default_rng(seed)
+    services = make_services(max(10, n_users // 500), rng)
+    subscribers = make_subscribers(n_users, services, start_date, rng)
+    sources = [
+        ('sam-platform_active.sql', 'sam_active', _normalize_active,
+         subscribers[subscribers['platform'] == 'sam']),
+        ('mcb_active.sql', 'mcb_active', _normalize_active,
+         subscribers[subscribers['platform'] == 'mcb'].assign(
+             status=lambda df: df['status'].map({'A': 'active', 'I': 'inactive'}))),
+        ('sam-platform_schedule.sql', 'sam_schedule', _normalize_schedule,
+         make_schedules(services, rng)),
+        ('redshift_trx_per_user.sql', 'red_trx_per_user', _normalize_redshift_transactions,
+         make_transactions(subscribers, rng)),
+    ]
+    for sql_file, cache_prefix, normalize, df in sources:
+        query = _render_query(sql_file, country, start_date, end_date)
+        query_cache.write(
+            normalize(df.reset_index(drop=True).copy()),
+            query_cache.cache_path(cache_prefix, country, start_date, end_date, query)
+        )
+    return make_broadcast_config(country, services, rng)
+
+
+def _timed(timings, stage, function):
+    start_time = time.perf_counter()
+    function()
+    timings[stage] = time.perf_counter() - start_time
+
+
+def run_scale(n_users, seed=0):
+    from openpyxl import Workbook
+    from homer import Country
+
+    country = 'ZZ'
+    start_date = datetime(2020, 6, 1)
+    end_date = start_date + timedelta(days=7)
+    broadcast_config = populate_cache(country, n_users, start_date, end_date, seed)
+
+    timings = {}
+    x = Country(country, start_date, end_date, broadcast_config, verbose=False)
+    _timed(timings, 'get_active_users', x.get_active_users)
+
+    # Re-run the two sub-stages of get_active_users on their inputs
+    from db_queries import _get_platform_schedule
+    x.df_schedules = _get_platform_schedule(country, start_date, end_date)
+    _timed(timings, 'select_unique_schedules', x.select_unique_schedules)
+    columns = ['platform', 'gateway', 'operator_code', 'service_identifier1',
+               'service_identifier2', 'frequency', 'active_users']
+    x.df_active_per_service = x.df_active_per_service[columns]
+    _timed(timings, 'add_broadcast_config', x.add_broadcast_config)
+
+    _timed(timings, 'get_redshift_transactions', x.get_redshift_transactions)
+    _timed(timings, 'set_active_with_trx', x.set_active_with_trx)
+    _timed(timings, 'run_analysis', x.run_analysis)
+    wb = Workbook(write_only=True)
+    _timed(timings, 'write_excel', lambda: (
+        x.write_excel(wb), wb.save(os.path.join(os.environ['BART_CACHE_DIR'], 'report.xlsx'))
+    ))
+    timings['services'] = len(x.df_active_per_service)
+    return timings
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for scale, timings in results.items():
+        for stage in STAGES:
+            before = baseline.get(scale, {}).get(stage)
+            if before is None:
+                continue
+            after = timings[stage]
+            # Ignore noise on stages that take only a few milliseconds
+            if after > before * (1 + tolerance) and after - before > 0.05:
+                regressions.append((scale, stage, before, after))
+    return regressions
+
+
+def print_results(results, baseline):
+    scales = list(results)
+    print('{:<28}'.format('stage') + ''.join('{:>16}'.format(s + ' users') for s in scales))
+    for stage in STAGES:
+        line = '{:<28}'.format(stage)
+        for scale in scales:
+            cell = '{:.3f}s'.format(results[scale][stage])
+            before = baseline.get(scale, {}).get(stage)
+            if before:
+                cell += ' ({:+.0f}%)'.format(100. * (results[scale][stage] / before - 1))
+            line += '{:>16}'.format(cell)
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the BART pipeline stages on synthetic data')
+    parser.add_argument('--scales', default='10000,100000,1000000',
+                        help='comma-separated numbers of subscribers')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these timings as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed slowdown relative to the baseline')
+    args = parser.parse_args(argv)
+
+    # Point the cache at a scratch directory before the BART modules load
+    os.environ['BART_CACHE_DIR'] = tempfile.mkdtemp(prefix='bart-bench-')
+    os.environ['BART_REPORTS_DIR'] = os.environ['BART_CACHE_DIR']
+    os.environ['CACHE_MAX_MB'] = str(10 ** 6)
+    os.environ.pop('REDSHIFT_INCREMENTAL', None)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    for scale in args.scales.split(','):
+        print('Running benchmark with {} subscribers...'.format(scale))
+        results[scale] = run_scale(int(scale), seed=args.seed)
+    print()
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('\nSaved baseline to {}'.format(args.baseline))
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for scale, stage, before, after in regressions:
+        print('REGRESSION: {} at {} users took {:.3f}s (baseline {:.3f}s)'.format(
+            stage, scale, after, before))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
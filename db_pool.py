@@ -0,0 +1,64 @@
+import queue
+import threading
+from contextlib import contextmanager
+
+
+class ConnectionPool(object):
+    def __init__(self, connect, size=4):
+        self.connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self):
+        # Blocks while all connections are checked out; a connection whose
+        # user raised is closed instead of being handed out again
+        self._slots.acquire()
+        try:
+            cnx = self._checkout()
+            try:
+                yield cnx
+            except Exception:
+                _close(cnx)
+                raise
+            self._idle.put(cnx)
+        finally:
+            self._slots.release()
+
+    def _checkout(self):
+        while True:
+            try:
+                cnx = self._idle.get_nowait()
+            except queue.Empty:
+                return self.connect()
+            if is_alive(cnx):
+                return cnx
+            _close(cnx)
+
+    def close_all(self):
+        while True:
+            try:
+                cnx = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _close(cnx)
+
+
+def is_alive(cnx):
+    try:
+        cur = cnx.cursor()
+        cur.execute('select 1')
+        cur.fetchall()
+        cur.close()
+        cnx.rollback()
+    except Exception:
+        return False
+    return True
+
+
+def _close(cnx):
+    try:
+        cnx.close()
+    except Exception:
+        pass
@@ -1,172 +1,613 @@
+import atexit
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import numpy as np
 import pandas as pd
-from mysql import connector
-import psycopg2
 
-from helper import CACHE_DIR, SQL_DIR, DTFormat
+import metrics
+import query_cache
+from db_pool import ConnectionPool
+from helper import SQL_DIR
 
 
-def query_postgresql(query, verbose=True):
-    if verbose: print(query+'\n')
-    connection_string = os.getenv('CONNECTION_STRING')
-    cur = psycopg2.connect(connection_string).cursor()
-    try:
-        start_time = time.time()
-        cur.execute(query)
-        end_time = time.time()
-        if verbose:
-            print('Query execution took {0:.1f} seconds\n\n\n'.format(end_time-start_time))
-    except Exception as e:
-        if verbose: print('Query failed: {}\n\n\n'.format(e))
-        return dict(), []
-    colnames = [desc[0] for desc in cur.description]
-    raw_data = cur.fetchall()
-    cur.close()
-    return raw_data, colnames
+# The database drivers are imported on first connect, so that working with
+# cached data does not load them
 
 
-def query_sam(query, verbose=True):
-    if verbose: print(query+'\n')
-    cnx = connector.connect(user=os.getenv('SAM_USER'),
-                            password=os.getenv('SAM_PASS'),
-                            host=os.getenv('SAM_HOST'))
-    cur = cnx.cursor()
-    try:
-        start_time = time.time()
-        cur.execute(query)
-        end_time = time.time()
-        if verbose:
-            print('Query execution took {0:.1f} seconds\n\n\n'.format(end_time-start_time))
-    except Exception as e:
-        if verbose: print('Query failed: {}\n\n\n'.format(e))
-        return dict(), []
-    colnames = [desc[0] for desc in cur.description]
-    raw_data = cur.fetchall()
-    cur.close()
-    cnx.close()
-    return raw_data, colnames
+def _connect_postgresql():
+    import psycopg2
+    return psycopg2.connect(os.getenv('CONNECTION_STRING'))
+
+
+def _connect_sam():
+    from mysql import connector
+    return connector.connect(user=os.getenv('SAM_USER'),
+                             password=os.getenv('SAM_PASS'),
+                             host=os.getenv('SAM_HOST'),
+                             port=int(os.getenv('SAM_PORT') or 3306))
+
+
+def _connect_mcb():
+    from mysql import connector
+    return connector.connect(user=os.getenv('MCB_USER'),
+                             password=os.getenv('MCB_PASS'),
+                             host=os.getenv('MCB_HOST'),
+                             port=int(os.getenv('MCB_PORT') or 3306))
+
+
+_connectors = {
+    'postgresql': _connect_postgresql,
+    'sam': _connect_sam,
+    'mcb': _connect_mcb,
+}
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_pool(source):
+    global _pools, _pools_pid
+    with _pools_lock:
+        # Connections inherited from a parent process must not be shared
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+        if source not in _pools:
+            size = int(os.getenv('DB_POOL_SIZE') or 4)
+            _pools[source] = ConnectionPool(_connectors[source], size=size)
+        return _pools[source]
+
+
+def close_pools():
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            return
+        for pool in _pools.values():
+            pool.close_all()
+
 
+atexit.register(close_pools)
 
-def query_mcb(query, verbose=True):
+
+def _cursor(source, cnx):
+    # Server-side cursors keep the result on the server until it is fetched;
+    # MySQL cursors are unbuffered by default and stream rows the same way
+    if source == 'postgresql':
+        return cnx.cursor(name='bart_fetch')
+    return cnx.cursor()
+
+
+def _concat_chunks(chunks, colnames):
+    if not chunks:
+        return pd.DataFrame(columns=colnames)
+    df = pd.concat(chunks, ignore_index=True)
+    # A chunk with only nulls in a column infers it as object; restore the
+    # dtype of the chunks that have values, as one DataFrame() call would
+    for col in df.columns:
+        if df[col].dtype != np.dtype('O'):
+            continue
+        kinds = set(chunk[col].dtype.kind for chunk in chunks if chunk[col].notnull().any())
+        if kinds == {'M'}:
+            df[col] = pd.to_datetime(df[col])
+        elif kinds and kinds <= {'i', 'u', 'f', 'b'}:
+            df[col] = pd.to_numeric(df[col])
+    return df
+
+
+def _query(source, query, verbose=True, chunksize=None):
     if verbose: print(query+'\n')
-    cnx = connector.connect(user=os.getenv('MCB_USER'),
-                            password=os.getenv('MCB_PASS'),
-                            host=os.getenv('MCB_HOST'))
-    cur = cnx.cursor()
-    try:
-        start_time = time.time()
-        cur.execute(query)
-        end_time = time.time()
-        if verbose:
-            print('Query execution took {0:.1f} seconds\n\n\n'.format(end_time-start_time))
-    except Exception as e:
-        if verbose: print('Query failed: {}\n\n\n'.format(e))
-        return dict(), []
-    colnames = [desc[0] for desc in cur.description]
-    raw_data = cur.fetchall()
-    cur.close()
-    cnx.close()
-    return raw_data, colnames
-
-
-def _get_from_db(country_code, start_date, end_date, query_function, query='', sql_file='', cache_prefix='', cache=True, verbose=True, min_trx_id=0):
-    data_file_path = '{}/{}_{}_{}_{}.csv'.format(
-        CACHE_DIR,
-        cache_prefix,
-        country_code,
-        start_date.strftime(DTFormat.Y_M_D),
-        end_date.strftime(DTFormat.Y_M_D)
-    )
-    if cache and os.path.exists(data_file_path):
+    if chunksize is None:
+        chunksize = int(os.getenv('DB_FETCH_CHUNKSIZE') or 50000)
+    with get_pool(source).connection() as cnx:
+        cur = _cursor(source, cnx)
         try:
-            df = pd.read_csv(data_file_path, low_memory=False)
-            return df
-        except pd.errors.EmptyDataError:
-            return pd.DataFrame()
+            start_time = time.time()
+            cur.execute(query)
+            rows = cur.fetchmany(chunksize)
+            end_time = time.time()
+            if verbose:
+                print('Query execution took {0:.1f} seconds'.format(end_time-start_time))
+        except Exception as e:
+            if verbose: print('Query failed: {}\n\n\n'.format(e))
+            # Close before the rollback: a named (server-side) cursor is no
+            # longer valid once its transaction ended
+            try:
+                cur.close()
+            except Exception:
+                pass
+            cnx.rollback()
+            return None
+        colnames = [desc[0] for desc in cur.description]
+        chunks = []
+        while rows:
+            chunks.append(pd.DataFrame.from_records(rows, columns=colnames, coerce_float=False))
+            rows = cur.fetchmany(chunksize) if len(rows) == chunksize else []
+        cur.close()
+        # End the read transaction so the pooled connection sees fresh data
+        cnx.rollback()
+    df = _concat_chunks(chunks, colnames)
+    nbytes = memory_usage(df)
+    metrics.add_bytes_fetched(nbytes)
+    if verbose:
+        elapsed = max(time.time() - start_time, 1e-6)
+        print('Fetched {} rows ({:.1f} MB) in {:.1f} seconds, {:.0f} rows/s\n\n\n'.format(
+            len(df), nbytes / 1e6, elapsed, len(df) / elapsed
+        ))
+    return df
 
-    if query == '' and sql_file == '':
-        pd.DataFrame().to_csv(data_file_path, index=False)
-        return pd.DataFrame()
 
+def query_postgresql(query, verbose=True, chunksize=None):
+    return _query('postgresql', query, verbose=verbose, chunksize=chunksize)
+
+
+def query_sam(query, verbose=True, chunksize=None):
+    return _query('sam', query, verbose=verbose, chunksize=chunksize)
+
+
+def query_mcb(query, verbose=True, chunksize=None):
+    return _query('mcb', query, verbose=verbose, chunksize=chunksize)
+
+
+_prefetched = {}
+
+
+def _render_query(sql_file, country_code, start_date, end_date, min_trx_id=0, **kwargs):
+    with open(SQL_DIR + '/{}'.format(sql_file)) as f:
+        query = f.read()
+    return query.format(
+        country_code=country_code,
+        start_date=start_date,
+        end_date=end_date,
+        sam_database='{}db'.format(country_code.lower()),
+        min_trx_id=min_trx_id,
+        **kwargs
+    )
+
+
+def _project(df, columns):
+    # Keep only the given columns (those of them that exist), in frame order
+    if columns is None:
+        return df
+    return df[[col for col in df.columns if col in columns]]
+
+
+def _get_from_db(country_code, start_date, end_date, query_function, query='', sql_file='', cache_prefix='', cache=True, verbose=True, min_trx_id=0, normalize=None, columns=None):
+    if query == '' and sql_file != '':
+        query = _render_query(sql_file, country_code, start_date, end_date, min_trx_id)
     if query == '':
-        with open(SQL_DIR + '/{}'.format(sql_file)) as f:
-            query = f.read()
-        query = query.format(
-            country_code=country_code,
-            start_date=start_date,
-            end_date=end_date,
-            sam_database='{}db'.format(country_code.lower()),
-            min_trx_id=min_trx_id
-        )
+        return pd.DataFrame()
 
-    raw_data, colnames = query_function(query, verbose=verbose)
+    # Parquet keeps the dtypes of the normalized frame; CSV caches lose them
+    # and are normalized again after reading. The cache holds every column;
+    # callers get only the columns they ask for.
+    data_file_path = query_cache.cache_path(
+        cache_prefix, country_code, start_date, end_date, query
+    )
+    if data_file_path in _prefetched:
+        return _project(_prefetched.pop(data_file_path), columns)
+    if cache:
+        df = query_cache.read(data_file_path, columns=columns)
+        if df is not None:
+            if data_file_path.endswith('.csv') and normalize is not None:
+                df = normalize(df)
+            return _project(df, columns)
 
-    df = pd.DataFrame(raw_data, columns=colnames)
+    df = query_function(query, verbose=verbose)
+    if df is None:
+        # Failed queries are not cached, so the next run retries them
+        return pd.DataFrame()
+    if normalize is not None:
+        df = normalize(df)
     if cache:
-        df.to_csv(data_file_path, index=False)
+        query_cache.write(df, data_file_path)
+    return _project(df, columns)
+
+
+INT_COLUMNS = ['accountid', 'msisdn', 'serviceid']
+CATEGORY_COLUMNS = ['platform', 'gateway', 'operator_code', 'status',
+                    'service_identifier1', 'service_identifier2']
+
+
+def compact_frame(df, int_columns=INT_COLUMNS, category_columns=CATEGORY_COLUMNS):
+    # Numeric ids as int64 when that round-trips losslessly (otherwise as
+    # strings) and low-cardinality keys as categoricals
+    for col in int_columns:
+        if col not in df or df[col].dtype != np.dtype('O'):
+            continue
+        values = pd.to_numeric(df[col], errors='coerce')
+        if (values.notnull().all() and values.dtype.kind == 'i'
+                and (values.astype(str) == df[col].astype(str)).all()):
+            df[col] = values.astype('int64')
+        else:
+            df[col] = df[col].astype(str)
+    for col in category_columns:
+        if col in df and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
     return df
 
 
-def _get_platform_active(country, start_date, end_date, cache=True):
-    df = pd.DataFrame()
+def align_key_dtypes(left, right, columns):
+    # Merging an int64 key with a string key fails; fall back to strings
+    for col in columns:
+        if (left[col].dtype.kind == 'i') != (right[col].dtype.kind == 'i'):
+            left[col] = left[col].astype(str)
+            right[col] = right[col].astype(str)
 
-    df_sam = _get_from_db(country, start_date, end_date, query_sam,
-                          sql_file='sam-platform_active.sql',
-                          cache_prefix='sam_active', cache=cache)
-    if not df_sam.empty:
-        df = df.append(df_sam, sort=True)
 
-    df_mcb = _get_from_db(country, start_date, end_date, query_mcb,
-                          sql_file='mcb_active.sql',
-                          cache_prefix='mcb_active', cache=cache)
-    if not df_mcb.empty:
-        df_mcb['status'].replace({'active': 'A', 'inactive': 'I'}, inplace=True)
-        df = df.append(df_mcb, sort=True)
+def memory_usage(df):
+    return df.memory_usage(deep=True).sum()
+
 
+def _normalize_active(df):
     if df.empty:
         return df
-
+    df['status'] = df['status'].replace({'active': 'A', 'inactive': 'I'})
     for col in ['accountid', 'msisdn', 'serviceid', 'service_identifier1', 'service_identifier2']:
-        if df[col].dtype not in [np.dtype('O'), np.dtype('float')]:
+        if col in INT_COLUMNS and df[col].dtype.kind == 'i':
+            df[col] = df[col].astype('int64')
+        elif df[col].dtype not in [np.dtype('O'), np.dtype('float')]:
             df[col] = df[col].astype(int).map(str)
         else:
             df[col] = df[col].astype(str)
+    return compact_frame(df)
 
-    return df
-
-
-def _get_platform_schedule(country, start_date, end_date, cache=True):
-    df = pd.DataFrame()
-
-    df_sam = _get_from_db(country, start_date, end_date, query_sam,
-                          sql_file='sam-platform_schedule.sql',
-                          cache_prefix='sam_schedule', cache=cache)
-    if not df_sam.empty:
-        df_sam['platform'] = 'sam'
-        df = df.append(df_sam, sort=True)
-    else:
-        for col in ['serviceid', 'operator_code', 'tariff', 'billing_days']:
-            df[col] = []
 
+def _normalize_schedule(df):
+    if df.empty:
+        return df
+    df['platform'] = 'sam'
     for col in ['operator_code']:
         if col in df:
             df[col] = df[col].fillna('Unknown')
     for col in ['scheduleid', 'serviceid', 'service_identifier1', 'service_identifier2', 'tariff']:
-        if col in df and df[col].dtype != np.dtype('O'):
+        if col in df and col in INT_COLUMNS and df[col].dtype.kind == 'i':
+            df[col] = df[col].astype('int64')
+        elif col in df and df[col].dtype != np.dtype('O'):
             df[col] = df[col].astype(int).map(str)
     if 'updatedate' in df:
         df['updatedate'] = pd.to_datetime(df['updatedate'])
-
-    return df
+    if 'frequency' in df:
+        df['frequency'] = pd.to_numeric(df['frequency']).fillna(-1).astype(int)
+    # operator_code holds comma-separated lists until select_unique_schedules
+    return compact_frame(df, category_columns=[])
 
 
-def _get_redshift_transactions(country, start_date, end_date, cache=True):
-    df = _get_from_db(country, start_date, end_date, query_postgresql,
-                      sql_file='redshift_trx_per_user.sql',
-                      cache_prefix='red_trx_per_user', cache=cache)
+def _normalize_redshift_transactions(df):
     for col in ['msisdn', 'service_identifier1', 'service_identifier2', 'tariff']:
-        if col in df and df[col].dtype != np.dtype('O'):
+        if col in df and col in INT_COLUMNS and df[col].dtype.kind == 'i':
+            df[col] = df[col].astype('int64')
+        elif col in df and df[col].dtype != np.dtype('O'):
             df[col] = df[col].astype(int).map(str)
+    return compact_frame(df)
+
+
+def _get_sam_active(country, start_date, end_date, cache=True, columns=None):
+    return _get_from_db(country, start_date, end_date, query_sam,
+                        sql_file='sam-platform_active.sql',
+                        cache_prefix='sam_active', cache=cache,
+                        normalize=_normalize_active, columns=columns)
+
+
+def _get_mcb_active(country, start_date, end_date, cache=True, columns=None):
+    return _get_from_db(country, start_date, end_date, query_mcb,
+                        sql_file='mcb_active.sql',
+                        cache_prefix='mcb_active', cache=cache,
+                        normalize=_normalize_active, columns=columns)
+
+
+def _get_sam_schedule(country, start_date, end_date, cache=True, columns=None):
+    if os.getenv('SCHEDULE_IN_SQL'):
+        # One row per (serviceid, operator_code) with its frequency, resolved
+        # by the database; needs MySQL 8 for the window function
+        return _get_from_db(country, start_date, end_date, query_sam,
+                            sql_file='sam-platform_schedule_resolved.sql',
+                            cache_prefix='sam_schedule_resolved', cache=cache,
+                            normalize=_normalize_schedule, columns=columns)
+    return _get_from_db(country, start_date, end_date, query_sam,
+                        sql_file='sam-platform_schedule.sql',
+                        cache_prefix='sam_schedule', cache=cache,
+                        normalize=_normalize_schedule, columns=columns)
+
+
+def _get_redshift_trx_per_user(country, start_date, end_date, cache=True, columns=None):
+    if os.getenv('REDSHIFT_INCREMENTAL'):
+        # The per-day partitions are summed over all their key columns first
+        return _project(_get_redshift_trx_per_user_incremental(
+            country, start_date, end_date, cache=cache), columns)
+    return _get_from_db(country, start_date, end_date, query_postgresql,
+                        sql_file='redshift_trx_per_user.sql',
+                        cache_prefix='red_trx_per_user', cache=cache,
+                        normalize=_normalize_redshift_transactions, columns=columns)
+
+
+def _get_redshift_trx_per_user_incremental(country, start_date, end_date, cache=True, verbose=True):
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days)]
+    if not days:
+        return pd.DataFrame()
+    partitions = _get_redshift_trx_partitions(country, days, cache=cache, verbose=verbose)
+    if partitions is None:
+        return pd.DataFrame()
+    return _sum_partitions([partitions[day] for day in days])
+
+
+def _get_redshift_trx_partitions(country, days, cache=True, verbose=True):
+    # Per-user counts add up over days, so windows are merged from cached
+    # per-day partitions and Redshift is only queried for the missing days
+    with open(SQL_DIR + '/redshift_trx_per_user_per_day.sql') as f:
+        template = f.read()
+
+    partitions = {}
+    missing = []
+    for day in days:
+        data_file_path = _day_partition_path(country, day, template)
+        df = query_cache.read(data_file_path) if cache else None
+        if df is None:
+            missing.append(day)
+            continue
+        if data_file_path.endswith('.csv'):
+            df = _normalize_redshift_transactions(df)
+        partitions[day] = df
+
+    # Query each run of consecutive missing days at once
+    runs = []
+    for day in missing:
+        if runs and runs[-1][-1] + timedelta(days=1) == day:
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+    for run in runs:
+        query = template.format(
+            country_code=country,
+            start_date=run[0],
+            end_date=run[-1] + timedelta(days=1)
+        )
+        df = query_postgresql(query, verbose=verbose)
+        if df is None:
+            return None
+        df = _normalize_redshift_transactions(df)
+        df['day'] = pd.to_datetime(df['day'])
+        for day in run:
+            partition = df[df['day'] == day].drop(columns='day').reset_index(drop=True)
+            # Only complete days are final
+            if cache and day + timedelta(days=1) <= datetime.utcnow():
+                query_cache.write(partition, _day_partition_path(country, day, template))
+            partitions[day] = partition
+    return partitions
+
+
+def _sum_partitions(partitions):
+    keys = ['rockman_id', 'msisdn', 'gateway', 'operator_code',
+            'service_identifier1', 'service_identifier2', 'platform']
+    df = pd.concat(partitions, ignore_index=True, sort=False)
+    df = df.astype({col: object for col in keys if isinstance(df[col].dtype, pd.CategoricalDtype)})
+    df = df.groupby(keys, as_index=False, dropna=False)[
+        ['total_transactions', 'delivered_transactions']
+    ].sum()
+    return compact_frame(df)
+
+
+def get_redshift_trx_per_day(country, start_date, end_date, verbose=True):
+    # Uncached per-day counts for a time range that may end mid-day
+    query = _render_query('redshift_trx_per_user_per_day.sql', country, start_date, end_date)
+    df = query_postgresql(query, verbose=verbose)
+    if df is None:
+        return None
+    df = _normalize_redshift_transactions(df)
+    df['day'] = pd.to_datetime(df['day'])
+    return df
+
+
+def _day_partition_path(country, day, template):
+    # Keyed on the SQL template rather than the rendered query, so that
+    # partitions fetched by different windows are shared
+    return query_cache.cache_path(
+        'red_trx_per_user_day', country, day, day + timedelta(days=1), template
+    )
+
+
+def _prefetch_all_countries(countries, start_date, end_date, query_function, sql_file, all_sql_file, cache_prefix, normalize, cache=True, verbose=True):
+    # One query for all countries instead of one per country. Each country's
+    # slice is stored under the key of its own per-country query, in memory
+    # and in the cache, where _get_from_db picks it up
+    paths = {}
+    for country in countries:
+        query = _render_query(sql_file, country, start_date, end_date)
+        data_file_path = query_cache.cache_path(
+            cache_prefix, country, start_date, end_date, query
+        )
+        if not (cache and os.path.exists(data_file_path)):
+            paths[country.upper()] = (country, data_file_path)
+    if not paths:
+        return
+
+    query = _render_query(
+        all_sql_file, '', start_date, end_date,
+        country_codes=', '.join("'{}'".format(code) for code in sorted(paths))
+    )
+    df = query_function(query, verbose=verbose)
+    if df is None:
+        return
+    df = normalize(df)
+    slices = dict(list(df.groupby(df['country_code'].str.upper(), sort=False)))
+    for code, (country, data_file_path) in paths.items():
+        df_country = slices.get(code, df.iloc[:0])
+        df_country = df_country.drop(columns='country_code').reset_index(drop=True)
+        if cache:
+            query_cache.write(df_country, data_file_path)
+        _prefetched[data_file_path] = df_country
+
+
+def prefetch_redshift_transactions(countries, start_date, end_date, cache=True, verbose=True):
+    if os.getenv('REDSHIFT_INCREMENTAL'):
+        return
+    _prefetch_all_countries(countries, start_date, end_date, query_postgresql,
+                            'redshift_trx_per_user.sql', 'redshift_trx_per_user_all.sql',
+                            'red_trx_per_user', _normalize_redshift_transactions,
+                            cache=cache, verbose=verbose)
+
+
+def prefetch_mcb_active(countries, start_date, end_date, cache=True, verbose=True):
+    # Only MCB has a shared schema; SAM keeps one database per country
+    _prefetch_all_countries(countries, start_date, end_date, query_mcb,
+                            'mcb_active.sql', 'mcb_active_all.sql',
+                            'mcb_active', _normalize_active,
+                            cache=cache, verbose=verbose)
+
+
+def _combine_platform_active(df_sam, df_mcb):
+    frames = [df for df in [df_sam, df_mcb] if not df.empty]
+    df = pd.concat(frames, sort=True) if frames else pd.DataFrame()
+
+    # Categoricals with different categories are appended as objects
+    return compact_frame(df)
+
+
+def _prepare_platform_schedule(df_sam):
+    if not df_sam.empty:
+        return df_sam
+    df = pd.DataFrame()
+    for col in ['serviceid', 'operator_code', 'tariff', 'billing_days']:
+        df[col] = []
     return df
+
+
+def _get_platform_active(country, start_date, end_date, cache=True, columns=None):
+    df_sam = _get_sam_active(country, start_date, end_date, cache=cache, columns=columns)
+    df_mcb = _get_mcb_active(country, start_date, end_date, cache=cache, columns=columns)
+    return _combine_platform_active(df_sam, df_mcb)
+
+
+def _get_platform_schedule(country, start_date, end_date, cache=True, columns=None):
+    df_sam = _get_sam_schedule(country, start_date, end_date, cache=cache, columns=columns)
+    return _prepare_platform_schedule(df_sam)
+
+
+def _get_redshift_transactions(country, start_date, end_date, cache=True, columns=None):
+    return _get_redshift_trx_per_user(country, start_date, end_date, cache=cache, columns=columns)
+
+
+def _fetch_source(name, function, country, start_date, end_date, cache, columns=None):
+    start_time = time.time()
+    try:
+        df = function(country, start_date, end_date, cache=cache, columns=columns)
+    except Exception as e:
+        return name, None, time.time() - start_time, e
+    return name, df, time.time() - start_time, None
+
+
+def get_country_sources(country, start_date, end_date, cache=True, verbose=True, columns=None):
+    # The four source queries of a country are independent and I/O-bound,
+    # so they run in parallel threads; each keeps its own timing and error.
+    # columns optionally maps 'active', 'schedule' and 'red_trx_per_user' to
+    # the columns to keep.
+    columns = columns or {}
+    sources = [
+        ('sam_active', _get_sam_active, 'active'),
+        ('mcb_active', _get_mcb_active, 'active'),
+        ('sam_schedule', _get_sam_schedule, 'schedule'),
+        ('red_trx_per_user', _get_redshift_trx_per_user, 'red_trx_per_user'),
+    ]
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = [
+            executor.submit(_fetch_source, name, function, country, start_date, end_date, cache,
+                            columns.get(source))
+            for name, function, source in sources
+        ]
+        fetched = [future.result() for future in futures]
+
+    frames = {}
+    errors = []
+    for name, df, elapsed, error in fetched:
+        if error is not None:
+            if verbose: print('Fetching {} for {} failed after {:.1f} seconds: {}'.format(
+                name, country, elapsed, error))
+            errors.append(error)
+            continue
+        if verbose: print('Fetched {} for {} in {:.1f} seconds ({} rows)'.format(
+            name, country, elapsed, len(df)))
+        frames[name] = df
+    if errors:
+        raise errors[0]
+
+    return {
+        'active': _combine_platform_active(frames['sam_active'], frames['mcb_active']),
+        'schedule': _prepare_platform_schedule(frames['sam_schedule']),
+        'red_trx_per_user': frames['red_trx_per_user'],
+    }
+
+
+BACKFILL_ACTIVE_COLUMNS = ['createdate', 'updatedate', 'status']
+
+
+def get_backfill_sources(country, windows, cache=True, verbose=True, columns=None):
+    # One fetch per source for a list of (start_date, end_date) windows: the
+    # active-user query run with the latest start and the earliest end
+    # returns a superset of every window's snapshot, the schedules do not
+    # depend on the dates, and transactions come as per-day partitions.
+    # The active users keep the columns needed to slice them per window.
+    columns = columns or {}
+    fetch_columns = dict(columns)
+    if columns.get('active') is not None:
+        fetch_columns['active'] = list(columns['active']) + BACKFILL_ACTIVE_COLUMNS
+    first_start = min(start for start, end in windows)
+    last_start = max(start for start, end in windows)
+    first_end = min(end for start, end in windows)
+    last_end = max(end for start, end in windows)
+    days = [first_start + timedelta(days=i) for i in range((last_end - first_start).days)]
+    sources = [
+        ('sam_active', _get_sam_active, (country, last_start, first_end), 'active'),
+        ('mcb_active', _get_mcb_active, (country, last_start, first_end), 'active'),
+        ('sam_schedule', _get_sam_schedule, (country, first_start, last_end), 'schedule'),
+    ]
+    with ThreadPoolExecutor(max_workers=len(sources) + 1) as executor:
+        futures = [
+            executor.submit(_fetch_source, name, function, *args, cache=cache,
+                            columns=fetch_columns.get(source))
+            for name, function, args, source in sources
+        ]
+        partitions = executor.submit(
+            _get_redshift_trx_partitions, country, days, cache=cache, verbose=verbose
+        )
+        fetched = [future.result() for future in futures]
+        partitions = partitions.result()
+
+    frames = {}
+    for name, df, elapsed, error in fetched:
+        if error is not None:
+            raise error
+        if verbose: print('Fetched {} for {} in {:.1f} seconds ({} rows)'.format(
+            name, country, elapsed, len(df)))
+        frames[name] = df
+    if partitions is None:
+        raise RuntimeError('Fetching transactions for {} failed'.format(country))
+
+    df_active = _combine_platform_active(frames['sam_active'], frames['mcb_active'])
+    if not df_active.empty:
+        df_active['createdate'] = pd.to_datetime(df_active['createdate'])
+        df_active['updatedate'] = pd.to_datetime(df_active['updatedate'])
+    return {
+        'active': df_active,
+        'schedule': _prepare_platform_schedule(frames['sam_schedule']),
+        'red_trx_per_day': partitions,
+        'columns': columns,
+    }
+
+
+def slice_backfill_sources(sources, start_date, end_date):
+    # The same filters as the per-window queries, applied in memory
+    df = sources['active']
+    if not df.empty:
+        df = df[(df['createdate'] < start_date) & (
+            (df['status'].astype(str).str.upper() == 'A') | (df['updatedate'] >= end_date)
+        )].reset_index(drop=True)
+    columns = sources['columns']
+    days = [start_date + timedelta(days=i) for i in range((end_date - start_date).days)]
+    df_trx = _sum_partitions([sources['red_trx_per_day'][day] for day in days])
+    return {
+        'active': _project(df, columns.get('active')),
+        'schedule': sources['schedule'].copy(),
+        'red_trx_per_user': _project(df_trx, columns.get('red_trx_per_user')),
+    }
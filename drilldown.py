@@ -0,0 +1,186 @@
+import argparse
+import io
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+import numpy as np
+import pandas as pd
+
+from helper import DTFormat, get_dates, get_output_dir, make_stage_filename, make_work_filename
+
+SERVICE_KEYS = ['platform', 'gateway', 'operator_code',
+                'service_identifier1', 'service_identifier2', 'frequency']
+
+
+class DrilldownIndex(object):
+    # The positions of a country's users ordered by service, plus one row
+    # per service with the range of its positions, so that a lookup only
+    # touches the services table and the matching users. The users
+    # themselves are the linked frame of the link stage, which is not
+    # stored a second time.
+    def __init__(self, rows, order, services):
+        self.rows = rows
+        self.order = order
+        self.services = services
+        self._ranges = dict(zip(
+            map(tuple, services[SERVICE_KEYS].values),
+            zip(services['start'].values, services['stop'].values)
+        ))
+
+    @classmethod
+    def build(cls, df):
+        positions = np.flatnonzero(df['accountid'].notnull().values)
+        groups = df.iloc[positions].groupby(
+            SERVICE_KEYS, observed=True, dropna=False).ngroup().values
+        order = np.argsort(groups, kind='stable')
+        groups = groups[order]
+        order = positions[order].astype(np.int32)
+
+        first = np.ones(len(groups), dtype=bool)
+        first[1:] = groups[1:] != groups[:-1]
+        services = pd.DataFrame(dict(
+            (key, df[key].values[order[first]].astype(str)) for key in SERVICE_KEYS
+        ))
+        services['start'] = np.flatnonzero(first)
+        services['stop'] = np.append(services['start'].values[1:], len(groups))
+        return cls(df, order, services)
+
+    def lookup(self, service):
+        # Any subset of the service columns; the full key is a dict lookup
+        service = dict((key, str(value)) for key, value in service.items() if key in SERVICE_KEYS)
+        if len(service) == len(SERVICE_KEYS):
+            ranges = [self._ranges.get(tuple(service[key] for key in SERVICE_KEYS))]
+            ranges = [r for r in ranges if r is not None]
+        else:
+            match = np.ones(len(self.services), dtype=bool)
+            for key, value in service.items():
+                match &= self.services[key].values == value
+            ranges = zip(self.services['start'].values[match], self.services['stop'].values[match])
+        positions = [self.order[start:stop] for start, stop in ranges]
+        df = self.rows.take(np.concatenate(positions) if positions else [])
+        df.index = pd.RangeIndex(len(df))
+        return df
+
+    def save(self, filename):
+        pd.to_pickle({'order': self.order, 'services': self.services, 'nrows': len(self.rows)},
+                     filename)
+
+    @classmethod
+    def load(cls, filename, rows):
+        saved = pd.read_pickle(filename)
+        if saved['nrows'] != len(rows):
+            raise ValueError('{} was built from other linked users'.format(filename))
+        return cls(rows, saved['order'], saved['services'])
+
+
+def index_filename(country, start_date, end_date):
+    return make_work_filename(start_date, end_date, '{}_drilldown'.format(country))
+
+
+def load_index(country, start_date, end_date, filename=None):
+    # The index of a past run together with the linked users of its link stage
+    link = pd.read_pickle(make_stage_filename(start_date, end_date, country, 'link'))
+    return DrilldownIndex.load(filename or index_filename(country, start_date, end_date),
+                               link['df_active_with_trx'])
+
+
+def parse_service(excel_string):
+    # A row pasted from the report: the service columns come first
+    values = excel_string.rstrip('\n').split('\t')
+    service = dict(zip(SERVICE_KEYS[:len(values)], values))
+    if 'frequency' in service:
+        service['frequency'] = int(service['frequency'])
+    return service
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # GET /<country>?platform=...&gateway=...[&format=json]
+    indexes = {}
+    start_date = end_date = work_dir = None
+
+    def index_filenames(self):
+        filenames = {}
+        if os.path.isdir(self.work_dir):
+            for name in os.listdir(self.work_dir):
+                match = re.match(r'^([A-Z]{2})_drilldown\.pkl$', name)
+                if match:
+                    filenames[match.group(1)] = os.path.join(self.work_dir, name)
+        return filenames
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        country = url.path.strip('/').upper()
+        params = dict(parse_qsl(url.query))
+        fmt = params.pop('format', 'csv')
+        if country not in self.indexes:
+            # Only country codes with an existing index, so that the path
+            # never reaches outside the work directory
+            filename = self.index_filenames().get(country)
+            if filename is None:
+                self.send_error(404, 'No drilldown index for {}'.format(country))
+                return
+            self.indexes[country] = load_index(country, self.start_date, self.end_date, filename)
+        df = self.indexes[country].lookup(params)
+        if fmt == 'json':
+            body = df.to_json(orient='records', date_format='iso').encode('utf-8')
+            content_type = 'application/json'
+        else:
+            f = io.StringIO()
+            df.to_csv(f, index=False)
+            body = f.getvalue().encode('utf-8')
+            content_type = 'text/csv'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(start_date, end_date, port):
+    _Handler.start_date, _Handler.end_date = start_date, end_date
+    _Handler.work_dir = get_output_dir(start_date, end_date) + '/work'
+    server = HTTPServer(('127.0.0.1', port), _Handler)
+    print('Serving drilldowns for {} on http://127.0.0.1:{}/<country>?<column>=<value>'.format(
+        start_date.strftime(DTFormat.Y_M_D), port))
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Look up the users of a service in a past run')
+    parser.add_argument('country', nargs='?', help='country code')
+    parser.add_argument('service', nargs='?',
+                        help='tab-separated service columns, e.g. a row pasted from the report '
+                             '(default: read from stdin)')
+    parser.add_argument('--start-date', help='first day of the week (default: last full week)')
+    parser.add_argument('--output', help='write the users to this CSV file instead of stdout')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='serve drilldowns over HTTP instead')
+    args = parser.parse_args(argv)
+
+    start_date, end_date = get_dates()
+    if args.start_date:
+        start_date = datetime.strptime(args.start_date, DTFormat.Y_M_D)
+        end_date = start_date + timedelta(days=7)
+    if args.serve:
+        serve(start_date, end_date, args.serve)
+        return 0
+    if not args.country:
+        parser.error('a country is required')
+
+    index = load_index(args.country, start_date, end_date)
+    service = parse_service(args.service if args.service is not None else sys.stdin.read())
+    df = index.lookup(service)
+    if args.output:
+        df.to_csv(args.output, index=False)
+        print('{} users written to {}'.format(len(df), args.output))
+    else:
+        df.to_csv(sys.stdout, index=False)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
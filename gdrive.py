@@ -1,6 +1,8 @@
-from os import getenv, path
+from os import getenv, getpid, makedirs, path, replace
 import io
+import json
 import pickle
+import threading
 import pandas as pd
 
 from email.mime.multipart import MIMEMultipart
@@ -9,17 +11,34 @@ from email.mime.text import MIMEText
 from email import encoders
 from smtplib import SMTP_SSL
 
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
-
-from helper import DTFormat, BASE_DIR
+from helper import DTFormat, BASE_DIR, REPORTS_DIR
 
 SCOPES = ['https://www.googleapis.com/auth/drive']
+BROADCAST_CONFIG_ID = '1JhOsRI4D9qUpQ2e5aoV7bs40paK6Eg9iavVGGHS3txI'
+# Kept next to the reports, out of reach of the query cache eviction
+BROADCAST_CONFIG_FILE = REPORTS_DIR + '/broadcast_config.csv'
+
+_service = None
+_service_pid = None
+_service_lock = threading.Lock()
 
 
 def gdrive_service():
+    # One client per process; the credentials refresh themselves on use
+    global _service, _service_pid
+    with _service_lock:
+        if _service is None or _service_pid != getpid():
+            _service = _build_service()
+            _service_pid = getpid()
+        return _service
+
+
+def _build_service():
+    # The Google client libraries are only loaded when Drive is used
+    from googleapiclient.discovery import build
+    from google_auth_oauthlib.flow import InstalledAppFlow
+    from google.auth.transport.requests import Request
+
     creds = None
     if path.exists(BASE_DIR+'/token.pickle'):
         with open(BASE_DIR+'/token.pickle', 'rb') as token:
@@ -40,20 +59,65 @@ def gdrive_service():
 
 
 def download_broadcast_config(verbose=True):
-    if verbose: print('Downloading broadcast configuration from Google Drive...')
-    service = gdrive_service()
+    # The exported CSV is kept in REPORTS_DIR together with the modifiedTime
+    # and version it was exported at, and only exported again when the
+    # spreadsheet changed. Without Drive access the kept copy is used.
+    cached = _read_config_meta()
+    if getenv('BROADCAST_CONFIG_OFFLINE') and cached:
+        if verbose: print('Using cached broadcast configuration (offline)...')
+        return _read_broadcast_config(BROADCAST_CONFIG_FILE)
+
+    try:
+        service = gdrive_service()
+        meta = service.files().get(
+            fileId=BROADCAST_CONFIG_ID, fields='modifiedTime,version'
+        ).execute()
+    except Exception as e:
+        if not cached:
+            raise
+        if verbose: print('Google Drive unavailable ({}), using cached broadcast configuration...'.format(e))
+        return _read_broadcast_config(BROADCAST_CONFIG_FILE)
+
+    if meta == cached:
+        if verbose: print('Broadcast configuration unchanged since {}, using cached copy...'.format(
+            meta['modifiedTime']))
+        return _read_broadcast_config(BROADCAST_CONFIG_FILE)
 
-    file_id = '1JhOsRI4D9qUpQ2e5aoV7bs40paK6Eg9iavVGGHS3txI'
-    request = service.files().export_media(fileId=file_id, mimeType='text/csv')
+    if verbose: print('Downloading broadcast configuration from Google Drive...')
+    from googleapiclient.http import MediaIoBaseDownload
+    request = service.files().export_media(fileId=BROADCAST_CONFIG_ID, mimeType='text/csv')
     fh = io.BytesIO()
     downloader = MediaIoBaseDownload(fh, request)
     done = False
     while done is False:
         status, done = downloader.next_chunk()
+    _write_atomic(BROADCAST_CONFIG_FILE, fh.getvalue())
+    _write_atomic(BROADCAST_CONFIG_FILE + '.json', json.dumps(meta).encode('utf-8'))
+    return _read_broadcast_config(BROADCAST_CONFIG_FILE)
+
+
+def _read_config_meta():
+    if not path.exists(BROADCAST_CONFIG_FILE):
+        return None
+    try:
+        with open(BROADCAST_CONFIG_FILE + '.json') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_atomic(filename, content):
+    if not path.exists(path.dirname(filename)):
+        makedirs(path.dirname(filename))
+    with open(filename + '.tmp', 'wb') as f:
+        f.write(content)
+    replace(filename + '.tmp', filename)
+
+
+def _read_broadcast_config(filename):
     drilldown_columns = ['country_code', 'gateway', 'operator_code',
                          'service_identifier1', 'service_identifier2']
-    df = pd.read_csv(io.StringIO(fh.getvalue().decode('utf-8')),
-                     dtype={col: 'str' for col in drilldown_columns})
+    df = pd.read_csv(filename, dtype={col: 'str' for col in drilldown_columns})
     for col in df.columns:
         fill = '*' if col in drilldown_columns else '?'
         df[col] = df[col].fillna(fill)
@@ -61,6 +125,8 @@ def download_broadcast_config(verbose=True):
 
 
 def upload_to_google_drive(local_filename, gdrive_filename):
+    from googleapiclient.http import MediaFileUpload
+
     service = gdrive_service()
     folder_id = '10QpFgtbBz5ncf3qdE1PbpPu0QGHcjTwg'
 
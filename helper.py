@@ -1,15 +1,17 @@
 import os
+import shutil
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-CACHE_DIR = BASE_DIR + '/cache'
-SQL_DIR = BASE_DIR + '/sql'
-REPORTS_DIR = BASE_DIR + '/reports'
 
 load_dotenv(BASE_DIR + '/.env')
 
+CACHE_DIR = os.getenv('BART_CACHE_DIR') or BASE_DIR + '/cache'
+SQL_DIR = BASE_DIR + '/sql'
+REPORTS_DIR = os.getenv('BART_REPORTS_DIR') or BASE_DIR + '/reports'
+
 
 class DTFormat:
     Y_M_D = '%Y-%m-%d'
@@ -28,19 +30,69 @@ def get_dates():
     return start_date, end_date
 
 
-def make_local_filename(start_date, end_date, country, extension):
-    output_dir = '{}/{}_{}'.format(
+def get_weeks(start_date, end_date):
+    # The full Monday-to-Monday weeks between two dates, starting at the
+    # first Monday on or after the start date
+    start_date = start_date + timedelta(days=-start_date.weekday() % 7)
+    weeks = []
+    while start_date + timedelta(days=7) <= end_date:
+        weeks.append((start_date, start_date + timedelta(days=7)))
+        start_date += timedelta(days=7)
+    return weeks
+
+
+def get_output_dir(start_date, end_date):
+    if start_date == end_date:
+        return '{}/{}'.format(REPORTS_DIR, start_date.strftime(DTFormat.Y_M_D))
+    return '{}/{}_{}'.format(
         REPORTS_DIR,
         start_date.strftime(DTFormat.Y_M_D),
         end_date.strftime(DTFormat.Y_M_D)
     )
-    if start_date == end_date:
-        output_dir = '{}/{}'.format(REPORTS_DIR, start_date.strftime(DTFormat.Y_M_D))
+
+
+def make_local_filename(start_date, end_date, country, extension):
+    output_dir = get_output_dir(start_date, end_date)
     if not os.path.exists(output_dir):
         os.mkdir(output_dir)
     return '{}/{}.{}'.format(output_dir, country, extension)
 
 
+def make_work_filename(start_date, end_date, name):
+    # Intermediates of the pipeline stages, next to the reports of the week
+    output_dir = os.path.dirname(make_local_filename(start_date, end_date, 'all', 'xlsx')) + '/work'
+    if not os.path.exists(output_dir):
+        os.mkdir(output_dir)
+    return '{}/{}.pkl'.format(output_dir, name)
+
+
+def make_stage_filename(start_date, end_date, country, stage):
+    return make_work_filename(start_date, end_date, '{}_{}'.format(country, stage))
+
+
+def prune_work_dirs(keep=None):
+    # Remove the stage intermediates of weeks that ended more than
+    # WORK_RETENTION_WEEKS (default 4, 0 keeps all) weeks ago, except those
+    # of the given output directories; the reports themselves are kept
+    weeks = int(os.getenv('WORK_RETENTION_WEEKS') or 4)
+    if weeks <= 0 or not os.path.isdir(REPORTS_DIR):
+        return []
+    cutoff = get_today() - timedelta(days=7 * weeks)
+    keep = [os.path.abspath(d) for d in keep or []]
+    removed = []
+    for name in os.listdir(REPORTS_DIR):
+        work_dir = os.path.join(REPORTS_DIR, name, 'work')
+        try:
+            end_date = datetime.strptime(name[-10:], DTFormat.Y_M_D)
+        except ValueError:
+            continue
+        if (end_date < cutoff and os.path.isdir(work_dir)
+                and os.path.abspath(os.path.dirname(work_dir)) not in keep):
+            shutil.rmtree(work_dir, ignore_errors=True)
+            removed.append(work_dir)
+    return removed
+
+
 def make_gdrive_filename(start_date, end_date):
     return 'Broadcast Report {} - {}'.format(
         start_date.strftime(DTFormat.Y_M_D),
@@ -1,11 +1,15 @@
-import pandas as pd
+import os
 
-from openpyxl.styles import Alignment, Font, numbers
-from openpyxl.utils import get_column_letter
-from openpyxl.utils.dataframe import dataframe_to_rows
+import numpy as np
+import pandas as pd
+from pandas.util import hash_pandas_object
 
-from db_queries import _get_platform_active, _get_platform_schedule, _get_redshift_transactions
-from helper import make_local_filename
+from db_queries import (
+    _get_platform_active, _get_platform_schedule, _get_redshift_transactions,
+    align_key_dtypes, compact_frame, get_country_sources, memory_usage
+)
+from drilldown import DrilldownIndex, index_filename, parse_service
+from helper import make_local_filename, make_stage_filename
 
 
 class Country(object):
@@ -26,21 +30,46 @@ class Country(object):
         self.df_red_trx_per_service = pd.DataFrame()
         self.df_active_with_trx = pd.DataFrame()
         self.results = pd.DataFrame()
+        self.link_stats = {}
+        self.sources = {}
+
+    def fetch_sources(self):
+        if self.verbose: print('Fetching data for {}...'.format(self.country))
+        self.sources = get_country_sources(
+            self.country, self.start_date, self.end_date, verbose=self.verbose,
+            columns=SOURCE_COLUMNS
+        )
 
     def get_active_users(self):
         if self.verbose: print('Finding active users in {}...'.format(self.country))
-        self.df_active = _get_platform_active(self.country, self.start_date, self.end_date)
+        if 'active' in self.sources:
+            self.df_active = self.sources.pop('active')
+        else:
+            self.df_active = _get_platform_active(self.country, self.start_date, self.end_date,
+                                                  columns=SOURCE_COLUMNS['active'])
         if self.df_active.empty:
             return
-        self.df_schedules = _get_platform_schedule(self.country, self.start_date, self.end_date)
-        self.select_unique_schedules()
+        if 'schedule' in self.sources:
+            self.df_schedules = self.sources.pop('schedule')
+        else:
+            self.df_schedules = _get_platform_schedule(self.country, self.start_date, self.end_date,
+                                                       columns=SOURCE_COLUMNS['schedule'])
+        # Schedules resolved in SQL come with one row per service and
+        # operator and their frequency already
+        resolved = 'frequency' in self.df_schedules
+        if not resolved:
+            self.select_unique_schedules()
+        align_key_dtypes(self.df_active, self.df_schedules, ['serviceid'])
         self.df_active = pd.merge(
             self.df_active,
-            self.df_schedules[['serviceid', 'operator_code', 'tariff', 'billing_days']],
+            self.df_schedules[['serviceid', 'operator_code', 'tariff', 'billing_days']
+                              + (['frequency'] if resolved else [])],
             how='left',
             on=['serviceid', 'operator_code']
         )
-        if self.df_active['billing_days'].notnull().sum() > 0:
+        if resolved:
+            self.df_active['frequency'] = self.df_active['frequency'].fillna(-1).astype(int)
+        elif self.df_active['billing_days'].notnull().sum() > 0:
             self.df_active['frequency'] = self.df_active['billing_days'].str.split(',').str.len().fillna(-1).astype(int)
         else:
             self.df_active['frequency'] = -1
@@ -51,13 +80,14 @@ class Country(object):
             self.df_active['service_identifier2'] = (
                 self.df_active['service_identifier2'].str.replace('ON ', '')
             )
+        self.df_active = compact_frame(self.df_active)
 
         columns = ['platform', 'gateway', 'operator_code',
                    'service_identifier1', 'service_identifier2', 'frequency']
         df = self.df_active[columns].copy()
         df['active_users'] = 1
         self.df_active_per_service = df.groupby(
-            columns, as_index=False
+            columns, as_index=False, observed=True
         ).agg('sum').sort_values(columns).reset_index(drop=True)
 
         self.add_broadcast_config()
@@ -65,63 +95,29 @@ class Country(object):
     def select_unique_schedules(self):
         if self.df_schedules.empty or 'serviceid' not in self.df_schedules:
             return
-        df_unique_schedules = pd.DataFrame()
-        serviceids = self.df_schedules['serviceid'].unique()
-        for serviceid in serviceids:
-            df_temp = pd.DataFrame()
-            df1 = self.df_schedules[self.df_schedules['serviceid'] == serviceid]
-            for i, row in df1.iterrows():
-                operator_codes = row['operator_code'].split(',')
-                for operator_code in operator_codes:
-                    row['operator_code'] = operator_code
-                    df_temp = df_temp.append(row, sort=True)
-            operator_codes = df_temp['operator_code'].unique()
-            for operator_code in operator_codes:
-                df2 = df_temp[df_temp['operator_code'] == operator_code]
-                if len(df2) == 1:
-                    schedule = df2.iloc[0]
-                else:
-                    idx = df2['schedule_status'] == 'A'
-                    if idx.sum() == 1:
-                        schedule = df2[idx].iloc[0]
-                    elif idx.sum() == 0:
-                        schedule = df2.sort_values('updatedate').iloc[-1]
-                    else:
-                        schedule = df2[idx].sort_values('updatedate').iloc[-1]
-                df_unique_schedules = df_unique_schedules.append(schedule, sort=True)
-        self.df_schedules = df_unique_schedules.copy().reset_index(drop=True)
+        # One row per (serviceid, operator_code), keeping first-seen order
+        df = self.df_schedules.copy()
+        df['operator_code'] = df['operator_code'].str.split(',')
+        df = df.explode('operator_code').reset_index(drop=True)
+        df['_order'] = np.arange(len(df))
+        df['_service_order'] = df.groupby('serviceid')['_order'].transform('min')
+        df['_pair_order'] = df.groupby(['serviceid', 'operator_code'])['_order'].transform('min')
+
+        # Prefer schedules with status 'A', then the latest updatedate
+        df['_active'] = df['schedule_status'] == 'A'
+        df = df.sort_values(
+            ['_active', 'updatedate'], kind='mergesort', na_position='last'
+        ).drop_duplicates(subset=['serviceid', 'operator_code'], keep='last')
+
+        df = df.sort_values(['_service_order', '_pair_order'])
+        self.df_schedules = df.drop(
+            columns=['_order', '_service_order', '_pair_order', '_active']
+        ).reset_index(drop=True)
 
     def add_broadcast_config(self):
-        if 'match_score' in self.broadcast_config.columns:
-            self.broadcast_config = self.broadcast_config.drop(columns='match_score')
-        drilldown_columns = ['gateway', 'operator_code',
-                             'service_identifier1', 'service_identifier2']
-        broadcast_info = {col: [] for col in self.broadcast_config.columns
-                          if col not in drilldown_columns}
-        for i, row in self.df_active_per_service.iterrows():
-            match_scores = []
-            for j, config in self.broadcast_config.iterrows():
-                mismatch = False
-                score = 0
-                for k, col in enumerate(drilldown_columns):
-                    if config[col] != '*' and config[col] != row[col]:
-                        mismatch = True
-                    elif config[col] == row[col]:
-                        score += 2 ** k
-                if mismatch:
-                    match_scores.append(0)
-                    continue
-                match_scores.append(score)
-            self.broadcast_config['match_score'] = match_scores
-            if self.broadcast_config['match_score'].max() > 0:
-                iconf = self.broadcast_config['match_score'].idxmax()
-                for col in broadcast_info:
-                    broadcast_info[col].append(self.broadcast_config.loc[iconf, col])
-            else:
-                for col in broadcast_info:
-                    broadcast_info[col].append('?')
-        for col in broadcast_info:
-            self.df_active_per_service[col] = broadcast_info[col]
+        self.df_active_per_service = match_broadcast_config(
+            self.df_active_per_service, self.broadcast_config
+        )
         self.df_active_per_service['muted'] = (pd.to_numeric(
             self.df_active_per_service['minimum_expected_transactions'], errors='coerce'
         ) < 0) & (pd.to_numeric(
@@ -130,8 +126,11 @@ class Country(object):
 
     def get_redshift_transactions(self):
         if self.verbose: print('Finding transactions for {}...'.format(self.country))
+        if 'red_trx_per_user' in self.sources:
+            self.df_red_trx_per_user = self.sources.pop('red_trx_per_user')
+            return
         self.df_red_trx_per_user = _get_redshift_transactions(
-            self.country, self.start_date, self.end_date
+            self.country, self.start_date, self.end_date, columns=SOURCE_COLUMNS['red_trx_per_user']
         )
 
     def print_summary(self):
@@ -140,45 +139,31 @@ class Country(object):
 
         print('\nActive users ({}):'.format(self.country))
         print(self.df_active[['platform', 'msisdn']].groupby(
-            'platform', as_index=False
+            'platform', as_index=False, observed=True
         ).agg('count'))
         print()
 
         print('Total transactions in Redshift ({}):'.format(self.country))
         print(self.df_red_trx_per_user[['platform', 'total_transactions']].groupby(
-            'platform', as_index=False
+            'platform', as_index=False, observed=True
         ).agg('sum'))
         print()
 
         print('Total transactions matched to active users ({}):'.format(self.country))
         print(self.df_active_with_trx[['platform', 'total_transactions']].groupby(
-            'platform', as_index=False
+            'platform', as_index=False, observed=True
         ).agg('sum'))
         print()
 
     def run_analysis(self):
         if self.verbose: print('Analyzing broadcasts in {}...'.format(self.country))
-        if self.df_active.empty:
+        if self.df_active_per_service.empty:
             return
 
-        self.results = pd.DataFrame()
-        for i, service in self.df_active_per_service.iterrows():
-            if service['muted']:
-                continue
-
-            df_this_service = get_active_for_service(service, self.df_active_with_trx)
-            if len(df_this_service) == 0:
-                print(i)
-
-            df2 = df_this_service[['total_transactions', 'users']].groupby(
-                'total_transactions', as_index=False
-            ).agg('sum')
-            these_results = pd.DataFrame(service).transpose()
-            if 0 not in df2['total_transactions'].values:
-                these_results[0] = 0
-            for j, row in df2.iterrows():
-                these_results[row['total_transactions']] = row['users']
-            self.results = self.results.append(these_results, sort=True)
+        self.results = build_histograms(
+            self.df_active_per_service[~self.df_active_per_service['muted'].astype(bool)],
+            self.df_active_with_trx
+        )
 
         if self.results.empty:
             return
@@ -186,110 +171,120 @@ class Country(object):
         self.df_active_per_service.drop(columns='muted', inplace=True)
         self.results.drop(columns='muted', inplace=True)
 
-        if len(self.results) > 0:
-            trx_counts = sorted(
-                set(self.results.columns) - set(self.df_active_per_service.keys())
-            )
-            for c in trx_counts:
-                self.results[c] = self.results[c].fillna(0).astype(int)
-            columns = list(self.df_active_per_service.keys()) + trx_counts
-            self.results = self.results[columns]
-
     def set_active_with_trx(self):
         if self.verbose:
             print('Linking transactions to active users in {}...'.format(self.country))
         if self.df_active.empty:
             return
 
-        trx_columns = ['total_transactions', 'delivered_transactions']
+        columns = LINK_KEYS.get(self.country, LINK_KEYS['default'])
+        align_key_dtypes(self.df_active, self.df_red_trx_per_user, columns)
+        self.df_active_with_trx, self.link_stats = link_transactions(
+            self.df_active, self.df_red_trx_per_user, columns
+        )
+        if self.verbose:
+            print('Matched {matched} transactions to active users, {unmatched} unmatched'.format(
+                **self.link_stats))
+        self.df_active_with_trx['users'] = 1
+        self.df_active_with_trx = compact_frame(self.df_active_with_trx)
+
+    def print_memory_report(self):
+        # Compare each frame with the same data held as object strings
+        print('Memory usage ({}):'.format(self.country))
+        for name in ['df_active', 'df_red_trx_per_user', 'df_active_with_trx']:
+            df = getattr(self, name)
+            if df.empty:
+                continue
+            compact = memory_usage(df)
+            expanded = memory_usage(df.astype({
+                col: str for col in df.columns
+                if df[col].dtype.kind == 'i' or isinstance(df[col].dtype, pd.CategoricalDtype)
+            }))
+            print('  {}: {:.1f} MB, {:.1f} MB as strings ({:.0f}% less)'.format(
+                name, compact / 1e6, expanded / 1e6, 100. * (1 - compact / max(expanded, 1))
+            ))
+        print()
 
-        # Match transactions to users with a rockman_id
-        idx = self.df_active['rockman_id'].notnull()
-        if idx.sum() > 0:
-            self.df_active_with_trx = pd.merge(
-                self.df_active[idx],
-                self.df_red_trx_per_user[['rockman_id'] + trx_columns],
-                how='left',
-                on='rockman_id'
-            )
-        else:
-            self.df_active_with_trx = pd.DataFrame(
-                columns=list(self.df_active.columns)+trx_columns
-            )
+    def drop_intermediates(self):
+        # Free the per-user frames once the results are known; only the
+        # per-service frames are needed to write the reports
+        self.df_active = pd.DataFrame()
+        self.df_schedules = pd.DataFrame()
+        self.df_red_trx_per_user = pd.DataFrame()
+        self.df_active_with_trx = pd.DataFrame()
+        self.sources = {}
 
-        # Match transactions to users without a rockman_id
-        idx = self.df_active['rockman_id'].isnull()
-        columns = ['msisdn', 'platform', 'service_identifier2']
-        if self.country == 'BE':
-            columns = ['msisdn']
-        elif self.country == 'IQ':
-            columns = ['msisdn', 'service_identifier2']
-        self.df_active_with_trx = self.df_active_with_trx.append(pd.merge(
-            self.df_active[idx],
-            self.df_red_trx_per_user[columns + trx_columns],
-            how='left',
-            on=columns
-        ), sort=True)
+    def save_drilldown_index(self):
+        if self.verbose: print('Indexing active users for drilldowns in {}...'.format(self.country))
+        if self.df_active_with_trx.empty:
+            return
+        DrilldownIndex.build(self.df_active_with_trx).save(
+            index_filename(self.country, self.start_date, self.end_date)
+        )
 
-        for col in trx_columns:
-            self.df_active_with_trx[col] = (
-                self.df_active_with_trx[col].fillna(0).astype(int)
-            )
-        self.df_active_with_trx['users'] = 1
+    def remove_drilldown_index(self):
+        filename = index_filename(self.country, self.start_date, self.end_date)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    def save_stage(self, stage, attributes):
+        # Pickles keep the dtypes (and the integer column names of the
+        # results) exactly as they are in memory. The file is replaced
+        # atomically, so it is either missing or complete and resumed runs
+        # can take it as a checkpoint.
+        filename = make_stage_filename(self.start_date, self.end_date, self.country, stage)
+        pd.to_pickle(dict((name, getattr(self, name)) for name in attributes), filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+    def load_stage(self, stage):
+        filename = make_stage_filename(self.start_date, self.end_date, self.country, stage)
+        for name, value in pd.read_pickle(filename).items():
+            setattr(self, name, value)
 
     def write_csv(self):
         if self.verbose: print('Writing results to CSV for {}...'.format(self.country))
-        if self.df_active.empty or self.results.empty:
+        if self.results.empty:
             return
         output_file = make_local_filename(self.start_date, self.end_date, self.country, 'csv')
         self.results.to_csv(output_file, index=False)
 
     def write_excel(self, wb):
+        from openpyxl.utils import get_column_letter
+        from openpyxl.utils.dataframe import dataframe_to_rows
+
         if self.verbose: print('Writing results to XLSX for {}...'.format(self.country))
-        if self.df_active.empty or self.results.empty:
+        if self.results.empty:
             return
 
         df = self.results.drop(columns='frequency')
-
-        # Dump results into basic sheet
-        ws = wb.create_sheet(self.country)
-        ws.append([])
         trxcol1 = len(self.df_active_per_service.columns) - 1
         ntrxcol = len(df.columns) - trxcol1
-        for r in dataframe_to_rows(df, index=False, header=True):
-            ws.append(r)
-
-        # Insert column with numbers of users with at least one transaction
-        ws.cell(row=2, column=trxcol1+1).value = 'Users without transactions'
-        ws.insert_cols(trxcol1+2)
-        ws.cell(row=2, column=trxcol1+2).value = 'Users with transactions'
-        for row in ws.iter_rows(min_row=3, min_col=trxcol1+2, max_col=trxcol1+2):
-            for cell in row:
-                cell.value = '=SUM({}{}:{}{})'.format(
-                    get_column_letter(trxcol1+3), cell.row,
-                    get_column_letter(trxcol1+1+ntrxcol), cell.row,
+        info_columns = [col for col in df.columns[:trxcol1] if col != 'active_users']
+        trx_counts = list(df.columns[trxcol1:])
+
+        # Final layout: service and config columns, active users, users
+        # without transactions, users with transactions (a SUM over the
+        # following columns), then one column per number of transactions
+        first_row = 3
+        df = df[info_columns + ['active_users', trx_counts[0]]].assign(
+            _with_trx=[
+                '=SUM({}{}:{}{})'.format(
+                    get_column_letter(trxcol1+3), r,
+                    get_column_letter(trxcol1+1+ntrxcol), r,
                 ) if ntrxcol > 1 else 0
-
-        # Move 'active_users' column to the right by two columns
-        icol = list(df.columns).index('active_users') + 1
-        ws.insert_cols(trxcol1+1)
-        for row in ws.iter_rows(min_row=2, min_col=trxcol1+1, max_col=trxcol1+1):
-            for cell in row:
-                cell.value = ws.cell(row=cell.row, column=icol).value
-        ws.delete_cols(icol, 1)
-
-        # Add/customize column headers
-        if ntrxcol > 1:
-            ws.cell(row=1, column=trxcol1+3).value = (
-                '# of users with a given number of transactions this week'
-            )
-            ws.cell(row=1, column=trxcol1+3).alignment = Alignment(horizontal='center')
-            ws.merge_cells(start_row=1, start_column=trxcol1+3,
-                           end_row=1, end_column=trxcol1+ntrxcol+1)
-        icol = list(df.columns).index('handled_by') - 1
-        for cell in ws[2][icol:trxcol1+2]:
-            cell.value = cell.value.capitalize().replace('_', ' ').replace(
-                ' dns', ' DNs')
+                for r in range(first_row, first_row + len(df))
+            ]
+        ).join(df[trx_counts[1:]])
+        ncols = len(df.columns)
+
+        header = info_columns + ['active_users', 'Users without transactions',
+                                 'Users with transactions'] + trx_counts[1:]
+        icol = info_columns.index('handled_by')
+        for j in range(icol, trxcol1+2):
+            header[j] = header[j].capitalize().replace('_', ' ').replace(' dns', ' DNs')
+
+        add_report_styles(wb)
+        ws = wb.create_sheet(self.country)
 
         # Set column widths and row heights
         widths = [56, 100, 123, 109, 109, 54, 41, 62, 46, 73, 73, 52, 73, 73]
@@ -297,19 +292,196 @@ class Country(object):
             ws.column_dimensions[get_column_letter(j+1)].width = w / 6.
         ws.row_dimensions[2].height = 48
 
-        # Apply cell formatting
-        for cell in ws[2][0:]:
-            cell.alignment = Alignment(wrap_text=True)
-        for row in ws.iter_rows(min_row=3, max_col=trxcol1-1):
-            for cell in row:
-                cell.number_format = numbers.FORMAT_TEXT
+        title = [None] * ncols
+        if ntrxcol > 1:
+            title[trxcol1+2] = '# of users with a given number of transactions this week'
+            ws.merged_cells.add('{}1:{}1'.format(
+                get_column_letter(trxcol1+3), get_column_letter(trxcol1+ntrxcol+1)
+            ))
+        ws.append([
+            _styled_cell(ws, value, 'bart_title' if value else 'bart_default')
+            for value in title
+        ])
+        ws.append([_styled_cell(ws, value, 'bart_header') for value in header])
+
+        styles = ['bart_text'] * (trxcol1-1) + ['bart_default'] * (ncols-trxcol1+1)
+        for row in dataframe_to_rows(df, index=False, header=False):
+            ws.append([_styled_cell(ws, value, style) for value, style in zip(row, styles)])
+
+
+def add_report_styles(wb):
+    from openpyxl.styles import Alignment, Font, NamedStyle, numbers
+
+    styles = [
+        NamedStyle(name='bart_default', font=Font(size=12)),
+        NamedStyle(name='bart_title', font=Font(size=12),
+                   alignment=Alignment(horizontal='center')),
+        NamedStyle(name='bart_header', font=Font(size=12),
+                   alignment=Alignment(wrap_text=True)),
+        NamedStyle(name='bart_text', font=Font(size=12),
+                   number_format=numbers.FORMAT_TEXT),
+    ]
+    for style in styles:
+        if style.name not in wb.named_styles:
+            wb.add_named_style(style)
+
+
+def _styled_cell(ws, value, style):
+    from openpyxl.cell import WriteOnlyCell
+
+    cell = WriteOnlyCell(ws, value=value)
+    cell.style = style
+    return cell
+
+
+# Columns used to link transactions to users without a rockman_id
+LINK_KEYS = {
+    'default': ['msisdn', 'platform', 'service_identifier2'],
+    'BE': ['msisdn'],
+    'IQ': ['msisdn', 'service_identifier2'],
+}
+
+# Columns of each source that the later stages use; the others are dropped
+# when the sources are read
+SOURCE_COLUMNS = {
+    'active': ['accountid', 'platform', 'msisdn', 'gateway', 'operator_code', 'serviceid',
+               'service_identifier1', 'service_identifier2', 'rockman_id'],
+    'schedule': ['serviceid', 'operator_code', 'tariff', 'billing_days', 'frequency',
+                 'schedule_status', 'updatedate'],
+    'red_trx_per_user': ['rockman_id'] + sorted(set(sum(LINK_KEYS.values(), [])))
+                        + ['total_transactions'],
+}
+
+
+def _hash_keys(df, columns, hash_key):
+    return hash_pandas_object(df[columns], index=False, hash_key=hash_key).values
+
+
+def link_transactions(df_active, df_trx, columns):
+    # Users with a rockman_id are linked on it, the others on the given
+    # columns. Both keys are hashed into one uint64 (with a different hash
+    # key per strategy), so a single merge handles both strategies
+    trx_columns = [col for col in ['total_transactions', 'delivered_transactions']
+                   if col in df_trx]
+    rockman_key, columns_key = 'bart-rockman-key', 'bart-columns-key'
+
+    has_rockman_id = df_active['rockman_id'].notnull().values
+    active_keys = np.where(
+        has_rockman_id,
+        _hash_keys(df_active, ['rockman_id'], rockman_key),
+        _hash_keys(df_active, columns, columns_key)
+    )
+    trx_rockman_keys = _hash_keys(df_trx, ['rockman_id'], rockman_key)
+    trx_columns_keys = _hash_keys(df_trx, columns, columns_key)
+    lookup = pd.DataFrame({
+        col: np.concatenate([df_trx[col].values, df_trx[col].values])
+        for col in trx_columns
+    })
+
+    df = pd.merge(
+        df_active, lookup, how='left', left_on=active_keys,
+        right_on=np.concatenate([trx_rockman_keys, trx_columns_keys])
+    )
+    del df['key_0']
+    for col in trx_columns:
+        df[col] = df[col].fillna(0).astype(int)
+
+    matched = (np.isin(trx_rockman_keys, active_keys[has_rockman_id])
+               | np.isin(trx_columns_keys, active_keys[~has_rockman_id]))
+    total = df_trx['total_transactions'].values
+    stats = {
+        'matched': int(total[matched].sum()),
+        'unmatched': int(total[~matched].sum()),
+    }
+    return df, stats
+
+
+def match_broadcast_config(df_services, broadcast_config):
+    # A config row matches a service if each drilldown column is either a
+    # wildcard or equal to the service's value; every equal column k adds
+    # 2**k to the match score and the highest (earliest on ties) score wins
+    drilldown_columns = ['gateway', 'operator_code',
+                         'service_identifier1', 'service_identifier2']
+    config = broadcast_config.drop(columns='match_score', errors='ignore')
+    info_columns = [col for col in config.columns if col not in drilldown_columns]
+    df = df_services.copy()
+    nservices = len(df)
+
+    services = df[drilldown_columns].astype(object).reset_index(drop=True)
+    services['_service'] = np.arange(nservices)
+    star_bits = np.zeros(nservices, dtype=int)
+    for k, col in enumerate(drilldown_columns):
+        star_bits += np.where(services[col] == '*', 2 ** k, 0)
+
+    # Index the config once per wildcard pattern, keeping the first row per key
+    keys = config[drilldown_columns].astype(object).reset_index(drop=True)
+    keys['_config'] = np.arange(len(keys))
+    patterns = pd.Series(0, index=keys.index)
+    for k, col in enumerate(drilldown_columns):
+        patterns += np.where(keys[col] != '*', 2 ** k, 0)
+
+    candidates = []
+    for pattern in patterns.unique():
+        on = [col for k, col in enumerate(drilldown_columns) if pattern & 2 ** k]
+        index = keys.loc[patterns == pattern, on + ['_config']]
+        if on:
+            index = index.drop_duplicates(subset=on, keep='first')
+            matched = pd.merge(services[on + ['_service']], index, how='inner', on=on)
+        else:
+            matched = services[['_service']].assign(_config=index['_config'].iloc[0])
+        matched['score'] = pattern | (star_bits[matched['_service'].values] & ~pattern)
+        candidates.append(matched[['_service', '_config', 'score']])
+
+    best = np.full(nservices, -1)
+    if candidates:
+        matches = pd.concat(candidates, ignore_index=True)
+        matches = matches[matches['score'] > 0].sort_values(
+            ['_service', 'score', '_config'], ascending=[True, False, True]
+        ).drop_duplicates(subset='_service', keep='first')
+        best[matches['_service'].values] = matches['_config'].values
+
+    for col in info_columns:
+        values = config[col].values
+        df[col] = [values[i] if i >= 0 else '?' for i in best]
+    return df
+
+
+def build_histograms(df_services, df_active_with_trx):
+    # Number of users per service with a given number of transactions, with
+    # one column per transaction count and a 0 column always present
+    keys = ['platform', 'gateway', 'operator_code',
+            'service_identifier1', 'service_identifier2', 'frequency']
+    if df_services.empty:
+        return pd.DataFrame()
+
+    df = df_active_with_trx[df_active_with_trx['accountid'].notnull()]
+    counts = df.groupby(keys + ['total_transactions'], observed=True)['users'].sum()
+    if len(counts) > 0:
+        hist = counts.unstack('total_transactions', fill_value=0)
+        hist.columns = list(hist.columns)
+        results = df_services.join(hist, on=keys)
+        # Counts that only other (muted) services have get no column
+        trx_counts = [c for c in hist.columns if results[c].fillna(0).any()]
+    else:
+        results = df_services.copy()
+        trx_counts = []
+
+    for i in results.index[results[trx_counts].isnull().all(axis=1)]:
+        print(i)
+
+    if 0 not in trx_counts:
+        results[0] = 0
+        trx_counts.append(0)
+    trx_counts = sorted(trx_counts)
+    for c in trx_counts:
+        results[c] = results[c].fillna(0).astype(int)
+    return results[list(df_services.columns) + trx_counts]
 
-        # Set font size
-        for row in ws:
-            for cell in row:
-                cell.font = Font(size=12)
 
 def get_active_for_service(service, df):
+    # df is either df_active_with_trx or its DrilldownIndex
+    if isinstance(df, DrilldownIndex):
+        return df.lookup(service)
     keys = ['platform', 'gateway', 'operator_code',
             'service_identifier1', 'service_identifier2', 'frequency']
     idx = df['accountid'].notnull()
@@ -320,10 +492,5 @@ def get_active_for_service(service, df):
 
 
 def get_active_from_excel(excel_string, df):
-    keys = ['platform', 'gateway', 'operator_code',
-            'service_identifier1', 'service_identifier2', 'frequency']
-    values = excel_string.split('\t')
-    service = pd.Series(dict(zip(keys[:len(values)], values)))
-    if 'frequency' in service:
-        service['frequency'] = int(service['frequency'])
+    service = pd.Series(parse_service(excel_string))
     return get_active_for_service(service, df)
@@ -0,0 +1,192 @@
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import query_cache
+from helper import REPORTS_DIR, get_output_dir, make_local_filename
+
+
+_records = []
+_bytes_fetched = [0]
+_week = [None]
+_lock = threading.Lock()
+
+METRICS = [
+    ('wall_seconds', 'Wall time of the stage'),
+    ('cpu_seconds', 'CPU time of the process during the stage'),
+    ('peak_rss_bytes', 'Peak resident memory of the process during the stage'),
+    ('rows_in', 'Rows going into the stage'),
+    ('rows_out', 'Rows coming out of the stage'),
+    ('bytes_fetched', 'Bytes fetched from the databases during the stage'),
+    ('cache_hits', 'Query cache hits during the stage'),
+    ('cache_misses', 'Query cache misses during the stage'),
+]
+
+
+def set_week(start_date, end_date):
+    # The week the following stages belong to; profiles are stored with it
+    _week[0] = (start_date, end_date)
+
+
+def add_bytes_fetched(n):
+    with _lock:
+        _bytes_fetched[0] += n
+
+
+def pop_records():
+    with _lock:
+        records = list(_records)
+        del _records[:]
+    return records
+
+
+def _reset_peak_rss():
+    # On Linux the high-water mark of the process can be reset, so that it
+    # covers one stage; elsewhere only the peak of the whole process is known
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _max_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _peak_rss(reset, max_rss_before):
+    if reset:
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except (IOError, OSError):
+            pass
+    # Without a reset, the process peak belongs to the stage only if the
+    # stage raised it
+    max_rss = _max_rss()
+    return max_rss if max_rss > max_rss_before else None
+
+
+@contextmanager
+def stage(country, name, rows_in=None):
+    # The yielded record can be completed by the caller, e.g. with rows_out
+    record = {'country': country, 'stage': name, 'rows_in': rows_in, 'rows_out': None}
+    cache_before = query_cache.stats()
+    bytes_before = _bytes_fetched[0]
+    # Stages should not overlap within a process, as each one resets the
+    # high-water mark
+    max_rss_before = _max_rss()
+    reset = _reset_peak_rss()
+    profile = _start_profile(name)
+    wall_start, cpu_start = time.time(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall_seconds'] = time.time() - wall_start
+        record['cpu_seconds'] = time.process_time() - cpu_start
+        _stop_profile(profile, country, name)
+        record['peak_rss_bytes'] = _peak_rss(reset, max_rss_before)
+        record['bytes_fetched'] = _bytes_fetched[0] - bytes_before
+        cache_after = query_cache.stats()
+        record['cache_hits'] = cache_after['hits'] - cache_before['hits']
+        record['cache_misses'] = cache_after['misses'] - cache_before['misses']
+        with _lock:
+            _records.append(record)
+
+
+def _profiled(name):
+    # BART_PROFILE=cprofile|tracemalloc, optionally limited to the stages
+    # listed in BART_PROFILE_STAGES
+    mode = os.getenv('BART_PROFILE')
+    stages = os.getenv('BART_PROFILE_STAGES')
+    if not mode or (stages and name not in stages.split(',')):
+        return None
+    return mode
+
+
+def _start_profile(name):
+    mode = _profiled(name)
+    if mode == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        return mode, profile
+    if mode == 'tracemalloc':
+        tracemalloc.start()
+        return mode, None
+    return None
+
+
+def _stop_profile(profile, country, name):
+    if profile is None:
+        return
+    mode, profiler = profile
+    profile_dir = REPORTS_DIR + '/profiles'
+    if _week[0] is not None:
+        profile_dir = get_output_dir(*_week[0]) + '/profiles'
+    # Workers of the same run can get here at the same time
+    os.makedirs(profile_dir, exist_ok=True)
+    path = '{}/{}_{}'.format(profile_dir, country, name)
+    if mode == 'cprofile':
+        profiler.disable()
+        profiler.dump_stats(path + '.prof')
+    else:
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        with open(path + '.txt', 'w') as f:
+            for stat in snapshot.statistics('lineno')[:50]:
+                f.write('{}\n'.format(stat))
+
+
+def write_report(records, start_date, end_date):
+    # A JSON run report plus a Prometheus textfile next to the XLSX report.
+    # A run that re-runs only some stages or countries replaces their
+    # records and keeps the others of the week.
+    json_file = make_local_filename(start_date, end_date, 'metrics', 'json')
+    try:
+        with open(json_file) as f:
+            previous = json.load(f)['stages']
+    except (IOError, ValueError, KeyError):
+        previous = []
+    rerun = set((record['country'], record['stage']) for record in records)
+    records = [record for record in previous
+               if (record['country'], record['stage']) not in rerun] + list(records)
+    report = {
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'finished_at': time.time(),
+        'stages': records,
+    }
+    _write_atomic(json_file, json.dumps(report, indent=2, default=str))
+
+    lines = []
+    for metric, description in METRICS:
+        lines.append('# HELP bart_stage_{} {}'.format(metric, description))
+        lines.append('# TYPE bart_stage_{} gauge'.format(metric))
+        for record in records:
+            if record.get(metric) is None:
+                continue
+            lines.append('bart_stage_{}{{country="{}",stage="{}"}} {}'.format(
+                metric, record['country'], record['stage'], record[metric]
+            ))
+    lines.append('# HELP bart_last_run_timestamp_seconds Time the last run finished')
+    lines.append('# TYPE bart_last_run_timestamp_seconds gauge')
+    lines.append('bart_last_run_timestamp_seconds {}'.format(report['finished_at']))
+    prom_file = make_local_filename(start_date, end_date, 'metrics', 'prom')
+    _write_atomic(prom_file, '\n'.join(lines) + '\n')
+    return json_file, prom_file
+
+
+def _write_atomic(path, content):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
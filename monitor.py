@@ -0,0 +1,243 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import traceback
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from db_queries import (
+    _normalize_redshift_transactions, _sum_partitions, get_redshift_trx_per_day
+)
+from helper import REPORTS_DIR, DTFormat, make_local_filename
+from homer import Country
+
+KEYS = ['rockman_id', 'msisdn', 'gateway', 'operator_code',
+        'service_identifier1', 'service_identifier2', 'platform']
+COUNTS = ['total_transactions', 'delivered_transactions']
+
+
+def _state_dir(country):
+    # Not under CACHE_DIR, whose eviction only expects query results
+    state_dir = '{}/{}'.format(os.getenv('MONITOR_STATE_DIR') or REPORTS_DIR + '/monitor', country)
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    return state_dir
+
+
+def load_state(country, week_start):
+    # The state of the current week: per-user transaction counts per day and
+    # what has been read so far. A new week starts from an empty state.
+    state_dir = _state_dir(country)
+    state = {'week': week_start.strftime(DTFormat.Y_M_D), 'watermark': None, 'files': []}
+    try:
+        with open(state_dir + '/state.json') as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        saved = None
+    if saved is None or saved['week'] != state['week']:
+        for path in glob.glob(state_dir + '/*.parquet'):
+            os.remove(path)
+        return state, {}
+
+    partitions = {}
+    for path in glob.glob(state_dir + '/day_*.parquet'):
+        day = datetime.strptime(os.path.basename(path)[4:14], DTFormat.Y_M_D)
+        partitions[day] = pd.read_parquet(path)
+    return saved, partitions
+
+
+def save_state(country, state, partitions, changed_days):
+    state_dir = _state_dir(country)
+    for day in changed_days:
+        path = '{}/day_{}.parquet'.format(state_dir, day.strftime(DTFormat.Y_M_D))
+        partitions[day].to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+    # Written last, so an interrupted run reads the same input again
+    with open(state_dir + '/state.json.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_dir + '/state.json.tmp', state_dir + '/state.json')
+
+
+def read_feed(feed, country, seen):
+    # A file or a directory of CSV/Parquet files with one row per
+    # transaction, returned as per-user counts per day. Files that were read
+    # before are skipped, so new data should come as new files that are
+    # complete when they appear
+    if os.path.isdir(feed):
+        paths = sorted(glob.glob(feed + '/*.csv') + glob.glob(feed + '/*.parquet'))
+    else:
+        paths = [feed]
+    frames = []
+    names = []
+    for path in paths:
+        st = os.stat(path)
+        name = '{}:{}:{}'.format(os.path.abspath(path), st.st_size, int(st.st_mtime))
+        if name in seen:
+            continue
+        if path.endswith('.parquet'):
+            df = pd.read_parquet(path)
+        else:
+            df = pd.read_csv(path, low_memory=False)
+        if 'country_code' in df:
+            df = df[df['country_code'].str.upper() == country.upper()]
+        # Counted per file, as the dtypes of CSV and Parquet files differ
+        if not df.empty:
+            frames.append(count_per_day(df))
+        names.append(name)
+    if not frames:
+        return pd.DataFrame(), names
+    return pd.concat(frames, ignore_index=True, sort=False), names
+
+
+def count_per_day(df):
+    # The aggregation of redshift_trx_per_user_per_day.sql, applied to a feed
+    df = df.copy()
+    if 'tariff' in df:
+        df = df[pd.to_numeric(df['tariff'], errors='coerce') > 0]
+    df['day'] = pd.to_datetime(df['timestamp']).dt.normalize()
+    df['rockman_id'] = df['rockman_id'].fillna('Unknown')
+    df['service_identifier2'] = df['service_identifier2'].fillna('Unknown')
+    df['delivered_transactions'] = (df['dnstatus'] == 'Delivered').astype(int)
+    df = df.groupby(['day'] + KEYS, as_index=False, dropna=False).agg(
+        total_transactions=('delivered_transactions', 'size'),
+        delivered_transactions=('delivered_transactions', 'sum'),
+    )
+    return _normalize_redshift_transactions(df)
+
+
+def add_transactions(partitions, df_new, replace=False):
+    # With replace, the new counts of a day are complete and replace the
+    # stored ones instead of being added to them
+    changed = []
+    for day, df in df_new.groupby('day'):
+        df = df.drop(columns='day')
+        if day in partitions and not replace:
+            df = pd.concat([partitions[day], df], ignore_index=True, sort=False)
+        partitions[day] = _sum_partitions([df])
+        changed.append(day)
+    return changed
+
+
+def flag_services(results, fraction, tolerance):
+    # Compare each service with its weekly expectations pro-rated to the
+    # elapsed part of the week: too few transactions per active user on
+    # average, or too many users already above the (pro-rated) maximum
+    df = results.copy()
+    trx_counts = [col for col in df.columns if isinstance(col, (int, np.integer))]
+    minimum = pd.to_numeric(df['minimum_expected_transactions'], errors='coerce')
+    maximum = pd.to_numeric(df['maximum_expected_transactions'], errors='coerce')
+    users = df[trx_counts].sum(axis=1).clip(lower=1)
+    df['transactions_per_user'] = sum(df[c] * c for c in trx_counts) / users
+    df['expected_minimum'] = minimum * fraction
+    df['expected_maximum'] = np.ceil(maximum * fraction)
+    over = np.zeros(len(df))
+    for c in trx_counts:
+        over += np.where(c > df['expected_maximum'], df[c], 0)
+    too_few = (minimum > 0) & (df['transactions_per_user'] < df['expected_minimum'] * (1 - tolerance))
+    too_many = (maximum >= 0) & (over > tolerance * users)
+    df['flag'] = np.where(too_few, 'too few transactions',
+                          np.where(too_many, 'too many transactions', ''))
+    return df
+
+
+def monitor_country(country, now, broadcast_config, feed=None, verbose=True):
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    week_start = today - timedelta(days=today.weekday())
+    state, partitions = load_state(country, week_start)
+
+    if feed is not None:
+        df_new, names = read_feed(feed, country, set(state['files']))
+        state['files'] += names
+    else:
+        # Only the days since the previous run are queried, from the start
+        # of the day: transactions that reached Redshift after that run
+        # can still have earlier timestamps, so these days are replaced
+        since = week_start
+        if state['watermark']:
+            since = max(since, datetime.strptime(state['watermark'], '%Y-%m-%d %H:%M:%S').replace(
+                hour=0, minute=0, second=0))
+        df_new = get_redshift_trx_per_day(country, since, now, verbose=verbose)
+        if df_new is None:
+            raise RuntimeError('Fetching transactions for {} failed'.format(country))
+        state['watermark'] = now.strftime('%Y-%m-%d %H:%M:%S')
+    if not df_new.empty:
+        df_new = df_new[df_new['day'] >= week_start]
+    changed = []
+    if not df_new.empty:
+        changed = add_transactions(partitions, df_new, replace=feed is None)
+    if verbose: print('Added {} new per-user counts for {}'.format(len(df_new), country))
+
+    x = Country(country, week_start, today, broadcast_config, verbose=verbose)
+    x.get_active_users()
+    x.df_red_trx_per_user = (_sum_partitions(list(partitions.values()))
+                             if partitions else pd.DataFrame(columns=KEYS + COUNTS))
+    x.set_active_with_trx()
+    x.run_analysis()
+    save_state(country, state, partitions, changed)
+    if x.results.empty:
+        return x.results
+
+    fraction = (now - week_start) / timedelta(days=7)
+    tolerance = float(os.getenv('MONITOR_TOLERANCE') or 0.5)
+    flagged = flag_services(x.results, fraction, tolerance)
+    # The config columns mix numbers with '?' for services without a match
+    flagged.rename(columns=str).astype(dict(
+        (str(col), str) for col in flagged.columns if flagged[col].dtype == object
+    )).to_parquet(_state_dir(country) + '/histograms.parquet', index=False)
+    output_file = make_local_filename(week_start, week_start + timedelta(days=7),
+                                      country + '_monitor', 'csv')
+    flagged.to_csv(output_file, index=False)
+    return flagged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check the current week for billing anomalies')
+    parser.add_argument('--feed', default=None,
+                        help='file or directory with new transactions instead of Redshift')
+    parser.add_argument('--countries', default=None, help='comma-separated country codes')
+    parser.add_argument('--config', default=None,
+                        help='broadcast configuration CSV instead of Google Drive')
+    args = parser.parse_args(argv)
+
+    if args.config:
+        from gdrive import _read_broadcast_config
+        broadcast_config = _read_broadcast_config(args.config)
+    else:
+        from gdrive import download_broadcast_config
+        broadcast_config = download_broadcast_config()
+    countries = broadcast_config['country_code'].unique()
+    if args.countries:
+        countries = args.countries.split(',')
+
+    now = datetime.utcnow().replace(microsecond=0)
+    nflagged = 0
+    failed = []
+    for country in countries:
+        try:
+            flagged = monitor_country(country, now, broadcast_config, feed=args.feed)
+        except Exception:
+            traceback.print_exc()
+            failed.append(country)
+            continue
+        if flagged.empty:
+            continue
+        flagged = flagged[flagged['flag'] != '']
+        nflagged += len(flagged)
+        for _, row in flagged.iterrows():
+            print('{}: {} {} {} {}/{}: {} ({:.2f} per user, expected {:.2f}-{:.0f})'.format(
+                country, row['platform'], row['gateway'], row['operator_code'],
+                row['service_identifier1'], row['service_identifier2'], row['flag'],
+                row['transactions_per_user'], row['expected_minimum'], row['expected_maximum']
+            ))
+    print('{} services flagged'.format(nflagged))
+    if failed:
+        print('Failed: {}'.format(', '.join(failed)))
+    return 1 if nflagged or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
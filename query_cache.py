@@ -0,0 +1,147 @@
+import hashlib
+import os
+import re
+import stat
+import tempfile
+import threading
+import time
+import pandas as pd
+import pyarrow.parquet as pq
+
+from helper import CACHE_DIR, DTFormat
+
+
+# The names cache_path() gives: prefix, country, dates, query hash
+_CACHE_FILE_RE = re.compile(r'^.+_\d{4}-\d{2}-\d{2}_\d{4}-\d{2}-\d{2}_[0-9a-f]{10}\.(parquet|csv)$')
+
+_stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats)
+
+
+def pop_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+        for key in _stats:
+            _stats[key] = 0
+    return stats
+
+
+def print_stats(stats):
+    lookups = stats['hits'] + stats['misses']
+    print('Cache: {} hits, {} misses ({:.0f}% hit rate), {} writes, {} evictions'.format(
+        stats['hits'], stats['misses'], 100. * stats['hits'] / max(lookups, 1),
+        stats['writes'], stats['evictions']
+    ))
+
+
+def cache_format():
+    return os.getenv('CACHE_FORMAT') or 'parquet'
+
+
+def cache_path(cache_prefix, country_code, start_date, end_date, query):
+    # The hash of the rendered SQL invalidates entries when a .sql file changes
+    query_hash = hashlib.sha1(query.encode('utf-8')).hexdigest()[:10]
+    return '{}/{}_{}_{}_{}_{}.{}'.format(
+        CACHE_DIR,
+        cache_prefix,
+        country_code,
+        start_date.strftime(DTFormat.Y_M_D),
+        end_date.strftime(DTFormat.Y_M_D),
+        query_hash,
+        cache_format()
+    )
+
+
+def _ttl():
+    return float(os.getenv('CACHE_TTL_HOURS') or 24 * 30) * 3600
+
+
+def read(data_file_path, columns=None):
+    # With columns, only those that exist in a Parquet file are read;
+    # CSV files are always read whole
+    try:
+        mtime = os.path.getmtime(data_file_path)
+        if time.time() - mtime > _ttl():
+            os.remove(data_file_path)
+            _count('evictions')
+            raise FileNotFoundError(data_file_path)
+        if data_file_path.endswith('.parquet'):
+            if columns is not None:
+                names = pq.read_schema(data_file_path).names
+                columns = [col for col in names if col in columns]
+            df = pd.read_parquet(data_file_path, columns=columns, memory_map=True)
+        else:
+            try:
+                df = pd.read_csv(data_file_path, low_memory=False)
+            except pd.errors.EmptyDataError:
+                df = pd.DataFrame()
+        # Access time drives LRU eviction; keep mtime for the TTL
+        os.utime(data_file_path, (time.time(), mtime))
+    except FileNotFoundError:
+        _count('misses')
+        return None
+    _count('hits')
+    return df
+
+
+def write(df, data_file_path):
+    # Write to a temporary file and rename it, so that concurrent workers
+    # never read a partially written cache file
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+    os.close(fd)
+    try:
+        if data_file_path.endswith('.parquet'):
+            df.to_parquet(tmp_path, index=False)
+        else:
+            df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, data_file_path)
+    except (TypeError, ValueError) as e:
+        # e.g. object columns mixing strings and numbers
+        os.remove(tmp_path)
+        print('Could not cache {}: {}'.format(data_file_path, e))
+        return
+    _count('writes')
+    if data_file_path.endswith('.parquet') and os.getenv('CACHE_CSV_EXPORT'):
+        df.to_csv(data_file_path[:-len('parquet')] + 'csv', index=False)
+    evict()
+
+
+def evict():
+    # Drop expired entries, then the least recently used ones until the
+    # cache fits in its size budget. Only query results are considered;
+    # anything else kept in CACHE_DIR is left alone.
+    budget = float(os.getenv('CACHE_MAX_MB') or 4096) * 1e6
+    now = time.time()
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if not _CACHE_FILE_RE.match(name):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if not stat.S_ISREG(st.st_mode):
+            continue
+        entries.append((st.st_atime, st.st_mtime, st.st_size, path))
+
+    total = sum(entry[2] for entry in entries)
+    for atime, mtime, size, path in sorted(entries):
+        if now - mtime <= _ttl() and total <= budget:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        _count('evictions')
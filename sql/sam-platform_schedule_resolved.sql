@@ -0,0 +1,40 @@
+with recursive bound as (
+    select max(length(telco) - length(replace(telco, ',', '')) + 1) as max_operators
+    from {sam_database}.sub_schedule
+), seq (n) as (
+    select 1
+    union all
+    select seq.n + 1 from seq
+    join bound on seq.n < bound.max_operators
+), schedule_operator as (
+    select
+        sch.scheduleid
+        , sch.serviceid
+        , substring_index(substring_index(coalesce(sch.telco, 'Unknown'), ',', seq.n), ',', -1) as operator_code
+        , sch.price as tariff
+        , sch.frequency as billing_days
+        , sch.status
+        , sch.updatedate
+    from {sam_database}.sub_schedule sch
+    join seq on seq.n <= length(coalesce(sch.telco, 'Unknown')) - length(replace(coalesce(sch.telco, 'Unknown'), ',', '')) + 1
+), ranked as (
+    select
+        serviceid
+        , operator_code
+        , tariff
+        , billing_days
+        , length(billing_days) - length(replace(billing_days, ',', '')) + 1 as frequency
+        , row_number() over (
+            partition by serviceid, operator_code
+            order by coalesce(status = 'A', 0) desc, updatedate is null desc, updatedate desc, scheduleid desc
+        ) as schedule_rank
+    from schedule_operator
+)
+select
+    serviceid
+    , operator_code
+    , tariff
+    , billing_days
+    , frequency
+from ranked
+where schedule_rank = 1
@@ -0,0 +1,28 @@
+from datetime import datetime
+
+from helper import get_weeks
+
+
+def test_monday_start():
+    assert get_weeks(datetime(2020, 1, 6), datetime(2020, 1, 20)) == [
+        (datetime(2020, 1, 6), datetime(2020, 1, 13)),
+        (datetime(2020, 1, 13), datetime(2020, 1, 20)),
+    ]
+
+
+def test_mid_week_start():
+    # Wednesday: the first full week starts on the following Monday
+    assert get_weeks(datetime(2020, 1, 8), datetime(2020, 1, 27)) == [
+        (datetime(2020, 1, 13), datetime(2020, 1, 20)),
+        (datetime(2020, 1, 20), datetime(2020, 1, 27)),
+    ]
+
+
+def test_partial_last_week():
+    assert get_weeks(datetime(2020, 1, 6), datetime(2020, 1, 19)) == [
+        (datetime(2020, 1, 6), datetime(2020, 1, 13)),
+    ]
+
+
+def test_no_full_week():
+    assert get_weeks(datetime(2020, 1, 8), datetime(2020, 1, 16)) == []
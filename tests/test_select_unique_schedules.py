@@ -0,0 +1,101 @@
+import random
+
+import pandas as pd
+import pytest
+
+from homer import Country
+
+
+def select_unique_schedules_loop(df_schedules):
+    # The row-by-row implementation select_unique_schedules replaced
+    df_unique_schedules = pd.DataFrame()
+    serviceids = df_schedules['serviceid'].unique()
+    for serviceid in serviceids:
+        rows = []
+        df1 = df_schedules[df_schedules['serviceid'] == serviceid]
+        for i, row in df1.iterrows():
+            operator_codes = row['operator_code'].split(',')
+            for operator_code in operator_codes:
+                row = row.copy()
+                row['operator_code'] = operator_code
+                rows.append(row)
+        df_temp = pd.DataFrame(rows)
+        operator_codes = df_temp['operator_code'].unique()
+        for operator_code in operator_codes:
+            df2 = df_temp[df_temp['operator_code'] == operator_code]
+            if len(df2) == 1:
+                schedule = df2.iloc[0]
+            else:
+                idx = df2['schedule_status'] == 'A'
+                if idx.sum() == 1:
+                    schedule = df2[idx].iloc[0]
+                elif idx.sum() == 0:
+                    schedule = df2.sort_values('updatedate').iloc[-1]
+                else:
+                    schedule = df2[idx].sort_values('updatedate').iloc[-1]
+            df_unique_schedules = pd.concat([df_unique_schedules, schedule.to_frame().T])
+    return df_unique_schedules.reset_index(drop=True)
+
+
+def select_unique_schedules(df_schedules):
+    x = Country.__new__(Country)
+    x.df_schedules = df_schedules.copy()
+    x.select_unique_schedules()
+    return x.df_schedules
+
+
+def assert_same_schedules(df_schedules):
+    expected = select_unique_schedules_loop(df_schedules)
+    result = select_unique_schedules(df_schedules)
+    assert list(result.columns) == list(df_schedules.columns)
+    pd.testing.assert_frame_equal(
+        result.astype(object), expected[result.columns].astype(object)
+    )
+
+
+def make_schedules(rows):
+    df = pd.DataFrame(rows, columns=['scheduleid', 'serviceid', 'operator_code',
+                                     'schedule_status', 'tariff', 'billing_days', 'updatedate'])
+    df['updatedate'] = pd.to_datetime(df['updatedate'])
+    return df
+
+
+def test_fixed_schedules():
+    assert_same_schedules(make_schedules([
+        # one active schedule among several
+        ['1', '10', 'op1', 'I', '100', '1', '2020-03-01'],
+        ['2', '10', 'op1', 'A', '200', '1,3', '2020-01-01'],
+        # several active ones: the latest wins
+        ['3', '11', 'op1,op2', 'A', '100', '1', '2020-01-01'],
+        ['4', '11', 'op2', 'A', '300', '1,3,5', '2020-02-01'],
+        # none active: the latest wins, and a missing updatedate beats any date
+        ['5', '12', 'op1', 'I', '100', '1', '2020-02-01'],
+        ['6', '12', 'op1', 'I', '200', '1,3', None],
+        ['7', '12', 'op1', 'I', '300', '1,3,5', '2020-01-01'],
+        # ties on updatedate: the last row wins
+        ['8', '13', 'op3,op1', 'A', '100', '1', '2020-01-01'],
+        ['9', '13', 'op1', 'A', '200', '1,3', '2020-01-01'],
+        ['10', '13', 'op3', 'I', '300', '1', '2020-01-01'],
+    ]))
+
+
+def test_missing_updatedate_wins():
+    df = make_schedules([
+        ['1', '10', 'op1', 'A', '100', '1', '2020-03-01'],
+        ['2', '10', 'op1', 'A', '200', '1,3', None],
+    ])
+    assert select_unique_schedules(df)['scheduleid'].tolist() == ['2']
+    assert_same_schedules(df)
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_random_schedules(seed):
+    r = random.Random(seed)
+    n = r.randint(1, 60)
+    assert_same_schedules(make_schedules([
+        [str(i), str(r.randint(1, 6)),
+         ','.join(r.sample(['op1', 'op2', 'op3', 'op4'], r.randint(1, 3))),
+         r.choice('AAI'), str(r.choice([100, 200])), r.choice(['1', '1,3', '1,3,5']),
+         r.choice(['2020-01-01', '2020-02-01', '2020-03-01', None])]
+        for i in range(n)
+    ]))